@@ -1,7 +1,10 @@
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+import argparse
 import os
+import sys
+from datetime import datetime
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -12,41 +15,273 @@ sender_email = os.getenv("SENDER_EMAIL")
 receiver_email = os.getenv("RECEIVER_EMAIL")
 password = os.getenv("EMAIL_PASSWORD")
 
-try:
-    # Create the message
+
+# Send the automated email to the receiver configured in .env
+def send_automated_email(args):
+    from mailer import SMTPConnectionPool
+    from relays import RelayRouter, load_relays
+    from suppression import AllRecipientsSuppressed, SuppressionList, send_filtered
+
+    suppression_list = SuppressionList()
+    try:
+        # Create the message
+        msg = MIMEMultipart()
+        msg['From'] = sender_email
+        msg['To'] = receiver_email
+        msg['Subject'] = "Automated Email Subject"
+
+        # Body of the email
+        body = "Hello, this is an automated email sent using Python!"
+
+        # Attach the email body to the email message
+        msg.attach(MIMEText(body, 'plain'))
+
+        # Send through the relays in the routing table (relays.json), which
+        # log in with the provided credentials unless they have their own.
+        # A receiver that failed permanently before is not even connected for.
+        print("Attempting to log in with provided credentials...")
+        print(f"Using email: {sender_email}")
+        router = RelayRouter(load_relays(), SMTPConnectionPool())
+        try:
+            _, _, refused = send_filtered(suppression_list, router, sender_email, password,
+                                          sender_email, [receiver_email], msg)
+        finally:
+            router.pool.close_all()
+
+        if refused:
+            from mailer import describe_smtp_error
+            print(describe_smtp_error(smtplib.SMTPRecipientsRefused(refused)))
+        else:
+            print("Email sent successfully!")
+
+    except AllRecipientsSuppressed:
+        print(f"{receiver_email} is on the suppression list; not sending.")
+
+    except smtplib.SMTPAuthenticationError:
+        print("Authentication failed. Please check the following:")
+        print("1. Make sure you're using an App Password (not your regular password)")
+        print("2. Verify the App Password is correct and hasn't expired")
+        print("3. Confirm that your Google account settings allow this connection")
+        print("4. You can generate a new App Password at: https://myaccount.google.com/apppasswords")
+
+    except smtplib.SMTPRecipientsRefused as e:
+        # Permanently refused addresses were added to the suppression list
+        from mailer import describe_smtp_error
+        print(describe_smtp_error(e))
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
+# Stream the (optionally filtered) email history into a CSV, JSONL or Parquet file
+def export_history_command(args):
+    from history import iter_history, iter_search_history
+    from history_export import write_export
+
+    statuses = args.status or None
+    if args.search:
+        records = iter_search_history(args.search, args.start, args.end, statuses)
+    else:
+        records = iter_history(args.start, args.end, statuses)
+
+    try:
+        if args.output == "-":
+            written = write_export(records, args.format, sys.stdout.buffer, args.chunk_size)
+        else:
+            with open(args.output, "wb") as f:
+                written = write_export(records, args.format, f, args.chunk_size)
+            print(f"Exported {written} bytes to {args.output}")
+    except Exception as e:
+        print(f"Export failed: {e}")
+        sys.exit(1)
+
+
+# Store a message to be sent later by a running scheduler
+def schedule_email_command(args):
+    from scheduler import Scheduler
+
+    try:
+        send_at = datetime.strptime(args.at, "%Y-%m-%d %H:%M")
+    except ValueError:
+        print("Invalid --at value, expected YYYY-MM-DD HH:MM")
+        sys.exit(1)
+    recipients = [email.strip() for email in (args.to or "").split(",") if email.strip()]
+    if not recipients:
+        print("No recipients given (use --to or set RECEIVER_EMAIL)")
+        sys.exit(1)
+
     msg = MIMEMultipart()
     msg['From'] = sender_email
-    msg['To'] = receiver_email
-    msg['Subject'] = "Automated Email Subject"
-
-    # Body of the email
-    body = "Hello, this is an automated email sent using Python!"
-
-    # Attach the email body to the email message
-    msg.attach(MIMEText(body, 'plain'))
-
-    # Connect to the SMTP server and send the email
-    server = smtplib.SMTP('smtp.gmail.com', 587)
-    server.starttls()  # Secure the connection
-    
-    print("Attempting to log in with provided credentials...")
-    print(f"Using email: {sender_email}")
-    server.login(sender_email, password)  # Log in to your email account
-    
-    # Send the email
-    server.sendmail(sender_email, receiver_email, msg.as_string())
-    
-    # Close the server connection
-    server.quit()
-    
-    print("Email sent successfully!")
-
-except smtplib.SMTPAuthenticationError:
-    print("Authentication failed. Please check the following:")
-    print("1. Make sure you're using an App Password (not your regular password)")
-    print("2. Verify the App Password is correct and hasn't expired")
-    print("3. Confirm that your Google account settings allow this connection")
-    print("4. You can generate a new App Password at: https://myaccount.google.com/apppasswords")
-
-except Exception as e:
-    print(f"An error occurred: {e}")
\ No newline at end of file
+    msg['To'] = ", ".join(recipients)
+    msg['Subject'] = args.subject
+    msg.attach(MIMEText(args.body, 'plain'))
+
+    # The scheduler thread is not started here; delivery is done by the app
+    # or by "python Main.py scheduler"
+    job_id = Scheduler(deliver=None).schedule(send_at, sender_email, recipients, args.subject, msg)
+    print(f"Scheduled email {job_id} for {send_at.strftime('%Y-%m-%d %H:%M')}")
+
+
+# Run the scheduler in the foreground, delivering due emails with the .env account
+def run_scheduler_command(args):
+    from worker import run_worker
+
+    print("Scheduler running (Ctrl+C to stop)")
+    run_worker(sender_email, password, batch_size=args.batch_size, poll_interval=args.poll_interval)
+
+
+# Run outbox worker processes that deliver queued and scheduled emails with the .env account
+def run_worker_command(args):
+    from worker import run_workers
+
+    print(f"Starting {args.processes} outbox workers for {sender_email} (Ctrl+C to stop)")
+    run_workers(args.processes, sender=sender_email, password=password, batch_size=args.batch_size,
+                poll_interval=args.poll_interval, lease_seconds=args.lease)
+
+
+# Match new bounce messages in an mbox file or maildir to the email history
+def ingest_bounces_command(args):
+    from bounces import BounceIngester
+    from suppression import SuppressionList
+
+    ingester = BounceIngester(args.state_file, SuppressionList(), batch_size=args.batch_size)
+    for path in args.mailbox:
+        if not os.path.exists(path):
+            print(f"Mailbox not found: {path}")
+            sys.exit(1)
+        ingester.ingest(path)
+    summary = ingester.summary
+    print(f"Read {summary['messages']} new messages: {summary['bounces']} bounces, "
+          f"{summary['matched']} matched to sent emails, {summary['unmatched']} unmatched")
+
+
+# Queue one personalized email per row of a CSV file with an "email" column.
+# The row's columns fill in the body template (HTML for .html files) and the
+# subject; delivery is done by the app or by "python Main.py worker".
+def mailmerge_command(args):
+    import csv
+    from scheduler import Scheduler
+    from suppression import SuppressionList
+    from templates import TemplateError, compile_template, load_partials
+
+    send_at = datetime.now()
+    if args.at:
+        try:
+            send_at = datetime.strptime(args.at, "%Y-%m-%d %H:%M")
+        except ValueError:
+            print("Invalid --at value, expected YYYY-MM-DD HH:MM")
+            sys.exit(1)
+
+    scheduler = Scheduler(deliver=None)
+    suppression_list = SuppressionList()
+    queued = skipped = 0
+    try:
+        with open(args.template, "r", encoding="utf-8") as f:
+            body_template = compile_template(f.read(), html_body=args.template.lower().endswith((".html", ".htm")))
+        subject_template = compile_template(args.subject, html_body=False)
+        partials = load_partials(args.partials)
+        with open(args.recipients, "r", newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                recipient = (row.get("email") or "").strip()
+                if not recipient or recipient in suppression_list:
+                    skipped += 1
+                    continue
+                context = dict(row, sender=sender_email)
+                subject = subject_template.render(context)
+                msg = MIMEMultipart()
+                msg['From'] = sender_email
+                msg['To'] = recipient
+                msg['Subject'] = subject
+                msg.attach(body_template.render_part(context, partials))
+                scheduler.schedule(send_at, sender_email, [recipient], subject, msg)
+                queued += 1
+    except (OSError, TemplateError) as e:
+        print(f"Mail merge failed after {queued} emails: {e}")
+        sys.exit(1)
+    print(f"Queued {queued} emails for {send_at.strftime('%Y-%m-%d %H:%M')}"
+          + (f", skipped {skipped} suppressed or empty addresses" if skipped else ""))
+
+
+# Probe every relay in the routing table once and print its state
+def check_relays_command(args):
+    from mailer import SMTPConnectionPool
+    from relays import RelayRouter, load_relays
+
+    relays = load_relays(args.file) if args.file else load_relays()
+    router = RelayRouter(relays, SMTPConnectionPool(), probe_timeout=args.timeout)
+    router.probe_all()
+    for relay in router.status():
+        state = "up" if relay["healthy"] else f"down ({relay['last_error']})"
+        latency = f"{relay['latency_ms']} ms" if relay["latency_ms"] is not None else "-"
+        print(f"{relay['name']:<16} {relay['host']:<32} weight {relay['weight']:<5g} {latency:<10} {state}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Automated email sender")
+    subparsers = parser.add_subparsers(dest="command")
+
+    send_parser = subparsers.add_parser("send", help="Send the automated email (default)")
+    send_parser.set_defaults(func=send_automated_email)
+
+    export_parser = subparsers.add_parser("export", help="Export email history")
+    export_parser.add_argument("output", help="Output file, or - for stdout")
+    export_parser.add_argument("--format", choices=["CSV", "JSONL", "Parquet"], default="CSV")
+    export_parser.add_argument("--start", help="First date to include (YYYY-MM-DD)")
+    export_parser.add_argument("--end", help="Last date to include (YYYY-MM-DD)")
+    export_parser.add_argument("--status", action="append", choices=["SUCCESS", "FAILED", "BOUNCED", "SUPPRESSED", "TEST"],
+                               help="Only export records with this status (repeatable)")
+    export_parser.add_argument("--search", help="Only export records matching this search text")
+    export_parser.add_argument("--chunk-size", type=int, default=10000)
+    export_parser.set_defaults(func=export_history_command)
+
+    schedule_parser = subparsers.add_parser("schedule", help="Schedule an email for later")
+    schedule_parser.add_argument("--at", required=True, help="Send time (YYYY-MM-DD HH:MM, local time)")
+    schedule_parser.add_argument("--to", default=receiver_email, help="Comma separated recipients")
+    schedule_parser.add_argument("--subject", default="Automated Email Subject")
+    schedule_parser.add_argument("--body", default="Hello, this is an automated email sent using Python!")
+    schedule_parser.set_defaults(func=schedule_email_command)
+
+    scheduler_parser = subparsers.add_parser("scheduler", help="Deliver scheduled emails as they become due")
+    scheduler_parser.add_argument("--batch-size", type=int, default=100)
+    scheduler_parser.add_argument("--poll-interval", type=float, default=30,
+                                  help="Seconds between checks for emails scheduled by other processes")
+    scheduler_parser.set_defaults(func=run_scheduler_command)
+
+    worker_parser = subparsers.add_parser("worker", help="Run outbox worker processes")
+    worker_parser.add_argument("--processes", type=int, default=1, help="Number of worker processes")
+    worker_parser.add_argument("--batch-size", type=int, default=10, help="Emails claimed at a time per worker")
+    worker_parser.add_argument("--poll-interval", type=float, default=1,
+                               help="Seconds between checks for new, retried or abandoned emails")
+    worker_parser.add_argument("--lease", type=float, default=60,
+                               help="Seconds a claimed email stays reserved without a heartbeat")
+    worker_parser.set_defaults(func=run_worker_command)
+
+    bounces_parser = subparsers.add_parser("ingest-bounces", help="Mark bounced emails in the history")
+    bounces_parser.add_argument("mailbox", nargs="+", help="mbox file or maildir directory holding bounce messages")
+    bounces_parser.add_argument("--state-file", default="bounce_state.json",
+                                help="Where the position reached in each mailbox is kept")
+    bounces_parser.add_argument("--batch-size", type=int, default=1000,
+                                help="Messages read between history updates")
+    bounces_parser.set_defaults(func=ingest_bounces_command)
+
+    mailmerge_parser = subparsers.add_parser("mailmerge", help="Queue a personalized email per CSV row")
+    mailmerge_parser.add_argument("--template", required=True, help="Body template (.html for HTML, anything else for plain text)")
+    mailmerge_parser.add_argument("--recipients", required=True, help="CSV file with an email column and template variables")
+    mailmerge_parser.add_argument("--subject", required=True, help="Subject, may use the same placeholders")
+    mailmerge_parser.add_argument("--partials", default="templates", help="Directory of partials for {%% include %%}")
+    mailmerge_parser.add_argument("--at", help="Send time (YYYY-MM-DD HH:MM, local time; default now)")
+    mailmerge_parser.set_defaults(func=mailmerge_command)
+
+    relays_parser = subparsers.add_parser("relays", help="Check the relays in the routing table")
+    relays_parser.add_argument("--file", help="Routing table to check (default: relays.json)")
+    relays_parser.add_argument("--timeout", type=float, default=5, help="Seconds to wait for each relay")
+    relays_parser.set_defaults(func=check_relays_command)
+
+    args = parser.parse_args()
+    if args.command is None:
+        args.func = send_automated_email
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,23 @@
 import streamlit as st
 import smtplib
 from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
+from email.utils import make_msgid
 import os
-import json
-from datetime import datetime
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import pandas as pd
-import time
+import tempfile
+from history import HistoryWriter, clear_history, history_start_date, search_history, iter_history, iter_search_history
+from history_export import EXPORT_FORMATS, write_export
+from history_frame import PAGE_SIZE, HistoryFrameCache, build_history_frame, format_timestamp, history_page, page_count, select_statuses, status_badge
+from mailer import SMTPConnectionPool, describe_smtp_error
+import metrics
+from sent_index import SentIndex, message_fingerprint
+from scheduler import Scheduler
+from relays import RelayRouter, load_relays
+from suppression import SuppressionList, send_filtered
+from templates import TemplateError, compile_template, load_partials, message_part, parse_variables
 
 # Load environment variables from .env file
 load_dotenv()
@@ -21,30 +30,6 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Function to load email history
-def load_history():
-    if os.path.exists("email_history.json"):
-        try:
-            with open("email_history.json", "r") as f:
-                return json.load(f)
-        except:
-            return []
-    return []
-
-# Function to save email history
-def save_to_history(sender, recipients, subject, status, error=None):
-    history = load_history()
-    history.append({
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "sender": sender,
-        "recipients": recipients,
-        "subject": subject,
-        "status": status,
-        "error": error
-    })
-    with open("email_history.json", "w") as f:
-        json.dump(history, f, indent=4)
-
 # Custom CSS for better styling
 st.markdown("""
 <style>
@@ -120,6 +105,61 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# One background history writer per process, shared by every session so
+# that concurrent sends are group-committed instead of racing on the file
+@st.cache_resource
+def get_history_writer():
+    return HistoryWriter()
+
+history_writer = get_history_writer()
+
+# The history frame is cached per process; reruns only read the records
+# appended to the history since the previous one
+@st.cache_resource
+def get_history_cache():
+    return HistoryFrameCache()
+
+# SMTP sessions are pooled per process and reused across reruns and sessions
+@st.cache_resource
+def get_smtp_pool():
+    return SMTPConnectionPool()
+
+smtp_pool = get_smtp_pool()
+
+# Relays from the routing table (relays.json), probed in the background
+@st.cache_resource
+def get_relay_router():
+    return RelayRouter(load_relays(), get_smtp_pool()).start()
+
+relay_router = get_relay_router()
+
+# Fingerprints of recently sent messages, shared by every session
+@st.cache_resource
+def get_sent_index():
+    return SentIndex()
+
+sent_index = get_sent_index()
+
+# Addresses that failed permanently, skipped before any connection is opened
+@st.cache_resource
+def get_suppression_list():
+    return SuppressionList()
+
+suppression_list = get_suppression_list()
+
+# Scheduled messages are delivered by one background scheduler per process
+@st.cache_resource
+def get_scheduler():
+    router = get_relay_router()
+    
+    def deliver(job, job_password):
+        _, suppressed, refused = send_filtered(get_suppression_list(), router, job["sender"],
+                                               job_password or default_password, job["sender"], job["recipients"],
+                                               job["message"])
+        return suppressed, refused
+    
+    return Scheduler(deliver, get_history_writer().save_to_history).start()
+
 # Sidebar for navigation
 with st.sidebar:
     st.image("https://ssl.gstatic.com/ui/v1/icons/mail/rfr/logo_gmail_lockup_default_1x_r5.png", width=200)
@@ -137,6 +177,9 @@ default_sender = os.getenv("SENDER_EMAIL", "")
 default_receiver = os.getenv("RECEIVER_EMAIL", "")
 default_password = os.getenv("EMAIL_PASSWORD", "")
 
+# Start delivering scheduled emails as soon as the app is loaded
+scheduler = get_scheduler()
+
 # Send Email Page
 if page == "Send Email":
     st.header("Send New Email")
@@ -164,6 +207,13 @@ if page == "Send Email":
         message_type = st.selectbox("Format", ["Plain Text", "HTML"], index=0)
         message = st.text_area("", "", height=200)
         
+        # Placeholders, conditionals and partials in the body (see templates.py)
+        with st.expander("Template"):
+            use_template = st.checkbox("Fill in template placeholders",
+                                       help='Use {{ name }}, {% if name %}...{% endif %} and {% include "partial" %}; partials are read from the templates folder')
+            template_variables = st.text_area("Template Variables", "", height=100,
+                                              help='One "name = value" per line. sender, subject and date are always set.')
+        
         # File attachment
         uploaded_file = st.file_uploader("Attach File (optional)", type=["pdf", "txt", "docx", "xlsx", "png", "jpg"])
         
@@ -174,6 +224,18 @@ if page == "Send Email":
             value="Normal"
         )
         
+        # Scheduled sending
+        next_hour = (datetime.now() + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+        col1, col2, col3 = st.columns([1, 2, 2])
+        with col1:
+            st.write("")
+            st.write("")
+            send_later = st.checkbox("Send Later")
+        with col2:
+            send_date = st.date_input("Send Date", value=next_hour.date())
+        with col3:
+            send_time = st.time_input("Send Time", value=next_hour.time())
+        
         # Password
         col1, col2 = st.columns([3, 1])
         with col1:
@@ -184,9 +246,16 @@ if page == "Send Email":
             st.write("")
             test_mode = st.checkbox("Test Mode", 
                                    help="In test mode, the email won't be sent but validation will be performed")
+            allow_duplicate = st.checkbox("Allow Duplicate",
+                                   help="Send even if an identical message was sent in the last few minutes")
         
         submit_button = st.form_submit_button(label="Send Email")
     
+    # Open an authenticated SMTP session in the background while the user is
+    # still filling in the form, so the send does not wait for the handshake
+    if sender_email and password and not test_mode:
+        relay_router.prewarm(sender_email, password)
+    
     # Handle form submission
     if submit_button:
         # Validate inputs
@@ -200,13 +269,51 @@ if page == "Send Email":
             # Validate email format (basic check)
             invalid_emails = [email for email in recipients_list + cc_list if "@" not in email or "." not in email]
             
+            # Render the body; HTML bodies are sent with a plain-text alternative
+            body = message
+            template_error = None
+            try:
+                if use_template:
+                    template = compile_template(message, html_body=message_type == "HTML")
+                    template_context = {"sender": sender_email, "subject": subject,
+                                        "date": datetime.now().strftime("%Y-%m-%d")}
+                    template_context.update(parse_variables(template_variables))
+                    partials = load_partials()
+                    body = template.render(template_context, partials)
+                    body_part = template.render_part(template_context, partials)
+                else:
+                    body_part = message_part(message, html_body=message_type == "HTML")
+            except TemplateError as e:
+                template_error = str(e)
+            
             if invalid_emails and invalid_emails != ['']: 
                 st.markdown(f"<div class='error-message'>Invalid email format: {', '.join(invalid_emails)}</div>", unsafe_allow_html=True)
+            elif send_later and datetime.combine(send_date, send_time) < datetime.now():
+                st.markdown("<div class='error-message'>The scheduled send time is in the past</div>", unsafe_allow_html=True)
+            elif template_error:
+                st.markdown(f"<div class='error-message'>Template error: {template_error}</div>", unsafe_allow_html=True)
             else:
+                # Recipients that failed permanently before are dropped here,
+                # before any connection to the relay is opened
+                deliverable, suppressed = suppression_list.filter(recipients_list + cc_list)
+                if suppressed:
+                    st.markdown(f"<div class='warning-message'>Skipping suppressed recipients (previous permanent failures): {', '.join(suppressed)}</div>", unsafe_allow_html=True)
+                
+                # Fingerprint used to catch identical resubmissions (reruns, double clicks)
+                fingerprint = message_fingerprint(
+                    sender_email, recipients_list + cc_list, subject, body,
+                    uploaded_file.getvalue() if uploaded_file is not None else None
+                )
+                
                 if test_mode:
                     st.markdown("<div class='warning-message'>Test Mode: Email validation passed, but message was not sent.</div>", unsafe_allow_html=True)
                     # Save to history in test mode
-                    save_to_history(sender_email, recipients_input, subject, "TEST", "Test mode - not actually sent")
+                    history_writer.save_to_history(sender_email, recipients_input, subject, "TEST", "Test mode - not actually sent")
+                elif not deliverable:
+                    st.markdown("<div class='error-message'>All recipients are on the suppression list, so nothing was sent.</div>", unsafe_allow_html=True)
+                    history_writer.save_to_history(sender_email, recipients_input, subject, "SUPPRESSED", "Address is on the suppression list")
+                elif not sent_index.claim(fingerprint, force=allow_duplicate):
+                    st.markdown(f"<div class='warning-message'>This exact message was already sent in the last {sent_index.window_seconds // 60} minutes, so it was not sent again. Tick \"Allow Duplicate\" to send it anyway.</div>", unsafe_allow_html=True)
                 else:
                     try:
                         # Create the message
@@ -216,6 +323,9 @@ if page == "Send Email":
                         if cc_input:
                             msg['Cc'] = cc_input
                         msg['Subject'] = subject
+                        # Lets bounces be matched to this send in the history
+                        msg['Message-ID'] = make_msgid(domain=sender_email.split("@")[-1])
+                        message_id = msg['Message-ID']
                         
                         # Set priority header if needed
                         if priority == "High":
@@ -224,10 +334,7 @@ if page == "Send Email":
                             msg['X-Priority'] = '5'
                         
                         # Body of the email
-                        if message_type == "Plain Text":
-                            msg.attach(MIMEText(message, 'plain'))
-                        else:
-                            msg.attach(MIMEText(message, 'html'))
+                        msg.attach(body_part)
                         
                         # Attach file if uploaded
                         if uploaded_file is not None:
@@ -239,52 +346,56 @@ if page == "Send Email":
                             )
                             msg.attach(attachment)
                         
-                        # Setup progress indicators
-                        progress_bar = st.progress(0)
-                        status_text = st.empty()
-                        
-                        # Connect to the SMTP server and send the email
-                        status_text.text("Connecting to SMTP server...")
-                        progress_bar.progress(20)
-                        time.sleep(0.5)
-                        
-                        server = smtplib.SMTP('smtp.gmail.com', 587)
-                        
-                        status_text.text("Securing connection...")
-                        progress_bar.progress(40)
-                        time.sleep(0.5)
-                        
-                        server.starttls()
-                        
-                        status_text.text("Authenticating...")
-                        progress_bar.progress(60)
-                        time.sleep(0.5)
-                        
-                        server.login(sender_email, password)
-                        
-                        status_text.text("Sending email...")
-                        progress_bar.progress(80)
-                        time.sleep(0.5)
-                        
-                        all_recipients = recipients_list + cc_list
-                        server.sendmail(sender_email, all_recipients, msg.as_string())
-                        
-                        status_text.text("Finishing up...")
-                        progress_bar.progress(100)
-                        time.sleep(0.5)
+                        all_recipients = deliverable
                         
-                        # Close the server connection
-                        server.quit()
-                        
-                        # Clear the status indicators
-                        status_text.empty()
-                        
-                        st.markdown("<div class='success-message'>Email sent successfully!</div>", unsafe_allow_html=True)
+                        if send_later:
+                            # Hand the message to the scheduler; it is delivered
+                            # and recorded in the history once it is due
+                            send_at = datetime.combine(send_date, send_time)
+                            scheduler.schedule(send_at, sender_email, all_recipients, subject, msg,
+                                                     recipients_input, password)
+                            st.markdown(f"<div class='success-message'>Email scheduled for {send_at.strftime('%Y-%m-%d %H:%M')}</div>", unsafe_allow_html=True)
+                        elif scheduler.live_workers(sender_email):
+                            # Outbox workers are running for this account, so the
+                            # message is queued for them instead of sent from here
+                            scheduler.schedule(datetime.now(), sender_email, all_recipients, subject, msg,
+                                               recipients_input, password, deliver_here=False)
+                            st.markdown("<div class='success-message'>Email queued for delivery by the outbox workers</div>", unsafe_allow_html=True)
+                        else:
+                            # Setup progress indicators
+                            progress_bar = st.progress(0)
+                            status_text = st.empty()
+                            
+                            # Send through the relays; a session opened in the background
+                            # when the page rendered is used if it is ready
+                            status_text.text("Sending email...")
+                            progress_bar.progress(50)
+                            
+                            _, _, refused = send_filtered(suppression_list, relay_router, sender_email, password,
+                                                          sender_email, all_recipients, msg)
+                            
+                            progress_bar.progress(100)
+                            
+                            # Clear the status indicators
+                            status_text.empty()
+                            
+                            st.markdown("<div class='success-message'>Email sent successfully!</div>", unsafe_allow_html=True)
+                            
+                            # Save to history
+                            if refused:
+                                refused_error = describe_smtp_error(smtplib.SMTPRecipientsRefused(refused))
+                                st.markdown(f"<div class='warning-message'>{refused_error}</div>", unsafe_allow_html=True)
+                                history_writer.save_to_history(sender_email, ", ".join(refused), subject, "FAILED", refused_error, message_id)
+                            if suppressed or refused:
+                                accepted = [address for address in all_recipients if address not in refused]
+                                history_writer.save_to_history(sender_email, ", ".join(accepted), subject, "SUCCESS", message_id=message_id)
+                            else:
+                                history_writer.save_to_history(sender_email, recipients_input, subject, "SUCCESS", message_id=message_id)
                         
-                        # Save to history
-                        save_to_history(sender_email, recipients_input, subject, "SUCCESS")
+                        if suppressed:
+                            history_writer.save_to_history(sender_email, ", ".join(suppressed), subject, "SUPPRESSED", "Address is on the suppression list", message_id)
                         
-                    except smtplib.SMTPAuthenticationError:
+                    except smtplib.SMTPAuthenticationError as e:
                         st.markdown("<div class='error-message'>Authentication failed. Please check your email and password.</div>", unsafe_allow_html=True)
                         with st.expander("More Information"):
                             st.write("1. Make sure you're using an App Password (not your regular password)")
@@ -292,87 +403,142 @@ if page == "Send Email":
                             st.write("3. Confirm that your Google account settings allow this connection")
                             st.write("4. You can generate a new App Password at: https://myaccount.google.com/apppasswords")
                         
+                        # Allow the message to be retried
+                        sent_index.release(fingerprint)
+                        
+                        # Save error to history
+                        history_writer.save_to_history(sender_email, recipients_input, subject, "FAILED", describe_smtp_error(e))
+                        
+                    except smtplib.SMTPRecipientsRefused as e:
+                        # Permanently refused addresses were added to the suppression list
+                        st.markdown(f"<div class='error-message'>{describe_smtp_error(e)}</div>", unsafe_allow_html=True)
+                        
+                        # Allow the message to be retried
+                        sent_index.release(fingerprint)
+                        
                         # Save error to history
-                        save_to_history(sender_email, recipients_input, subject, "FAILED", "Authentication error")
+                        history_writer.save_to_history(sender_email, recipients_input, subject, "FAILED", describe_smtp_error(e))
                         
                     except Exception as e:
                         st.markdown(f"<div class='error-message'>An error occurred: {e}</div>", unsafe_allow_html=True)
                         
+                        # Allow the message to be retried
+                        sent_index.release(fingerprint)
+                        
                         # Save error to history
-                        save_to_history(sender_email, recipients_input, subject, "FAILED", str(e))
+                        history_writer.save_to_history(sender_email, recipients_input, subject, "FAILED", describe_smtp_error(e))
+
+    # Upcoming scheduled emails
+    pending_total, pending_jobs = scheduler.pending()
+    if pending_total:
+        with st.expander(f"Scheduled Emails ({pending_total} pending)"):
+            for job in pending_jobs:
+                st.write(f"**{datetime.fromtimestamp(job['send_at']).strftime('%Y-%m-%d %H:%M')}** - "
+                         f"{job['subject']} (to {job['recipients']})")
+            if pending_total > len(pending_jobs):
+                st.write(f"... and {pending_total - len(pending_jobs)} more")
 
 # Email History Page
 elif page == "Email History":
     st.header("Email History")
     
-    history = load_history()
+    # Display filters
+    col1, col2 = st.columns(2)
+    with col1:
+        status_filter = st.multiselect(
+            "Filter by Status",
+            options=["SUCCESS", "FAILED", "BOUNCED", "SUPPRESSED", "TEST"],
+            default=["SUCCESS", "FAILED", "BOUNCED", "SUPPRESSED", "TEST"]
+        )
+    
+    with col2:
+        # Only the history segments overlapping this range are read from disk
+        today = datetime.now().date()
+        date_range = st.date_input(
+            "Filter by Date",
+            value=(today.replace(day=1), today),
+            min_value=history_start_date(),
+            max_value=today
+        )
+        if isinstance(date_range, (tuple, list)):
+            start_date = date_range[0] if date_range else None
+            end_date = date_range[-1] if date_range else None
+        else:
+            start_date = end_date = date_range
+    
+    # Search box backed by the full-text history index
+    search_text = st.text_input(
+        "Search",
+        "",
+        help="Search subjects, recipients, senders and error messages (e.g. a domain like example.com)"
+    )
     
-    if not history:
-        st.info("No email history found. Start sending emails to build your history.")
+    # Load into a compact columnar frame (see history_frame.py)
+    if search_text.strip():
+        df = build_history_frame(search_history(search_text, start_date, end_date, status_filter))
+    else:
+        df = get_history_cache().frame(start_date, end_date)
+    
+    if df.empty:
+        st.info("No email history found for the selected dates. Start sending emails to build your history.")
     else:
-        # Convert to DataFrame for display
-        df = pd.DataFrame(history)
-        
-        # Add status badges
-        def format_status(status):
-            if status == "SUCCESS":
-                return f"<span class='status-badge status-success'>Success</span>"
-            elif status == "FAILED":
-                return f"<span class='status-badge status-failed'>Failed</span>"
-            elif status == "TEST":
-                return f"<span class='status-badge' style='background-color:#e2e3e5;color:#383d41'>Test</span>"
-            return status
-        
-        df['formatted_status'] = df['status'].apply(format_status)
-        
-        # Display filters
-        col1, col2 = st.columns(2)
-        with col1:
-            status_filter = st.multiselect(
-                "Filter by Status",
-                options=["SUCCESS", "FAILED", "TEST"],
-                default=["SUCCESS", "FAILED", "TEST"]
-            )
-        
-        with col2:
-            if 'timestamp' in df.columns:
-                dates = df['timestamp'].str.split(' ').str[0].unique().tolist()
-                date_filter = st.multiselect(
-                    "Filter by Date",
-                    options=dates,
-                    default=dates
-                )
-        
         # Apply filters
-        filtered_df = df[df['status'].isin(status_filter)]
-        if 'timestamp' in filtered_df.columns and date_filter:
-            filtered_df = filtered_df[filtered_df['timestamp'].str.split(' ').str[0].isin(date_filter)]
+        filtered_df = select_statuses(df, status_filter)
+        
+        # Export the filtered records, streamed in chunks into a temporary file
+        with st.expander("Export History"):
+            export_format = st.selectbox("Export Format", list(EXPORT_FORMATS.keys()))
+            if st.button("Prepare Export"):
+                if search_text.strip():
+                    records = iter_search_history(search_text, start_date, end_date, status_filter)
+                else:
+                    records = iter_history(start_date, end_date, status_filter)
+                try:
+                    extension, mime = EXPORT_FORMATS[export_format]
+                    with tempfile.TemporaryDirectory() as export_dir:
+                        export_path = os.path.join(export_dir, f"email_history.{extension}")
+                        with open(export_path, "wb") as f:
+                            write_export(records, export_format, f)
+                        with open(export_path, "rb") as f:
+                            st.download_button(
+                                "Download Export",
+                                data=f,
+                                file_name=f"email_history.{extension}",
+                                mime=mime
+                            )
+                except Exception as e:
+                    st.error(f"Failed to export history: {e}")
         
         # Display the data
         if not filtered_df.empty:
-            st.write(f"Showing {len(filtered_df)} records")
+            # Only one page of records is rendered, badges included
+            pages = page_count(filtered_df)
+            page_number = st.number_input("Page", min_value=1, max_value=pages, value=1, step=1) if pages > 1 else 1
+            page_df = history_page(filtered_df, page_number)
+            first = (page_number - 1) * PAGE_SIZE
+            st.write(f"Showing records {first + 1}-{first + len(page_df)} of {len(filtered_df)}")
             
             # Custom display of data
-            for i, row in filtered_df.iterrows():
+            for row in page_df.itertuples(index=False):
                 with st.container():
                     col1, col2, col3 = st.columns([2, 3, 1])
                     with col1:
-                        st.write(f"**Date:** {row['timestamp']}")
-                        st.write(f"**From:** {row['sender']}")
+                        st.write(f"**Date:** {format_timestamp(row.timestamp)}")
+                        st.write(f"**From:** {row.sender}")
                     with col2:
-                        st.write(f"**Subject:** {row['subject']}")
-                        st.write(f"**To:** {row['recipients']}")
+                        st.write(f"**Subject:** {row.subject}")
+                        st.write(f"**To:** {row.recipients}")
                     with col3:
-                        st.markdown(f"**Status:** {row['formatted_status']}", unsafe_allow_html=True)
-                        if row['status'] == "FAILED" and row['error']:
+                        st.markdown(f"**Status:** {status_badge(row.status)}", unsafe_allow_html=True)
+                        if row.status in ("FAILED", "BOUNCED", "SUPPRESSED") and row.error:
                             with st.expander("Error Details"):
-                                st.error(row['error'])
+                                st.error(row.error)
                     st.markdown("---")
             
             # Option to clear history
             if st.button("Clear History"):
                 try:
-                    os.remove("email_history.json")
+                    clear_history()
                     st.success("History cleared successfully!")
                     st.experimental_rerun()
                 except Exception as e:
@@ -384,7 +550,7 @@ elif page == "Email History":
 elif page == "Settings":
     st.header("App Settings")
     
-    tabs = st.tabs(["Account Settings", "App Password Help", "About"])
+    tabs = st.tabs(["Account Settings", "App Password Help", "Metrics", "Suppression List", "About"])
     
     with tabs[0]:
         st.subheader("Email Account Settings")
@@ -429,6 +595,41 @@ elif page == "Settings":
                 caption="Example of Gmail App Password page")
     
     with tabs[2]:
+        st.subheader("Delivery Metrics")
+        
+        snapshot = metrics.snapshot()
+        if not snapshot["counters"] and not snapshot["timings"]:
+            st.info("No metrics recorded yet in this process.")
+        else:
+            if snapshot["timings"]:
+                st.write("**Latencies**")
+                st.dataframe(pd.DataFrame(snapshot["timings"]).T.round(1))
+            if snapshot["counters"]:
+                st.write("**Counters**")
+                st.dataframe(pd.Series(snapshot["counters"], name="count"))
+        
+        st.write("**Relays**")
+        st.dataframe(pd.DataFrame(relay_router.status()))
+    
+    with tabs[3]:
+        st.subheader("Suppression List")
+        st.write("Addresses that were permanently refused (5xx) by the mail server are not sent to again.")
+        
+        entries = suppression_list.entries()
+        if not entries:
+            st.info("No suppressed addresses.")
+        else:
+            st.write(f"{len(suppression_list)} suppressed addresses")
+            entries_df = pd.DataFrame(entries)
+            entries_df['added_at'] = pd.to_datetime(entries_df['added_at'], unit='s').dt.strftime('%Y-%m-%d %H:%M:%S')
+            st.dataframe(entries_df)
+            
+            address_to_remove = st.selectbox("Address", [entry['address'] for entry in entries])
+            if st.button("Remove From Suppression List"):
+                suppression_list.remove(address_to_remove)
+                st.success(f"{address_to_remove} will be sent to again.")
+    
+    with tabs[4]:
         st.subheader("About This App")
         
         st.write("""
@@ -441,6 +642,7 @@ elif page == "Settings":
         - File attachments
         - Email priority settings
         - Email history tracking
+        - Suppression of addresses that hard-bounced
         - Test mode for validation without sending
         
         ### Technology Stack:
@@ -0,0 +1,888 @@
+import argparse
+import json
+import multiprocessing
+import os
+import smtplib
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Benchmarks and stress tests for the email tooling. Every benchmark runs in
+# a scratch directory so the real history files and databases are untouched.
+#
+#     python benchmark.py history-writers --writers 50 --records 200
+#     python benchmark.py smtp-latency --rtt 0.02
+#     python benchmark.py scheduler-lag --idle 50000 --due 20000
+#     python benchmark.py bounce-ingest --messages 1000000
+#     python benchmark.py outbox-workers --messages 2000 --workers 1,2,4,8
+#     python benchmark.py history-frame --records 1000000
+#     python benchmark.py history-reruns --records 1000000
+#     python benchmark.py history-search --records 1000000
+#     python benchmark.py relay-failover --messages 300 --slow-rtt 0.2
+#     python benchmark.py template-render --bodies 20000
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+@contextmanager
+def scratch_dir():
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        os.chdir(path)
+        try:
+            yield path
+        finally:
+            os.chdir(previous)
+
+
+def report(name, **values):
+    print(f"{name}: " + ", ".join(f"{key}={value}" for key, value in values.items()))
+
+
+# The pre-segmentation implementation: read the whole file, append, rewrite
+def _legacy_save_to_history(record):
+    history = []
+    if os.path.exists("email_history.json"):
+        try:
+            with open("email_history.json", "r") as f:
+                history = json.load(f)
+        except ValueError:
+            history = []
+    history.append(record)
+    with open("email_history.json", "w") as f:
+        json.dump(history, f, indent=4)
+
+
+def _count_unique_subjects(records):
+    return len({record["subject"] for record in records})
+
+
+def _process_writer(worker, records):
+    from history import save_to_history
+    for i in range(records):
+        save_to_history("bench@example.com", "to@example.com", f"p{worker}-{i}", "SUCCESS")
+
+
+# Stress test: many concurrent writers must not lose a single record. Exits
+# with status 1 if the group-commit writer or the locked writes lose or
+# duplicate any record.
+def bench_history_writers(args):
+    from history import HistoryWriter, load_history
+    expected = args.writers * args.records
+    failures = []
+
+    with scratch_dir():
+        def legacy_writer(worker):
+            for i in range(args.records):
+                _legacy_save_to_history({"subject": f"t{worker}-{i}"})
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=legacy_writer, args=(w,)) for w in range(args.writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        try:
+            with open("email_history.json", "r") as f:
+                kept = _count_unique_subjects(json.load(f))
+        except ValueError:
+            kept = 0
+        report("legacy read-modify-write", writers=args.writers, expected=expected,
+               kept=kept, lost=expected - kept, seconds=f"{elapsed:.2f}")
+
+    with scratch_dir():
+        writer = HistoryWriter(flush_interval=args.flush_interval)
+
+        def queued_writer(worker):
+            for i in range(args.records):
+                writer.save_to_history("bench@example.com", "to@example.com", f"t{worker}-{i}", "SUCCESS")
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=queued_writer, args=(w,)) for w in range(args.writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.flush()
+        elapsed = time.perf_counter() - start
+        writer.close()
+        history = load_history()
+        kept = _count_unique_subjects(history)
+        report("group-commit writer (threads)", writers=args.writers, expected=expected,
+               kept=kept, lost=expected - kept, duplicates=len(history) - kept,
+               seconds=f"{elapsed:.2f}", records_per_sec=f"{expected / elapsed:.0f}")
+        if kept != expected or len(history) != kept:
+            failures.append("group-commit writer (threads)")
+
+    with scratch_dir():
+        start = time.perf_counter()
+        processes = [
+            multiprocessing.Process(target=_process_writer, args=(w, args.records))
+            for w in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+        history = load_history()
+        kept = _count_unique_subjects(history)
+        expected = args.processes * args.records
+        report("locked writes (processes)", writers=args.processes, expected=expected,
+               kept=kept, lost=expected - kept, duplicates=len(history) - kept, seconds=f"{elapsed:.2f}")
+        if kept != expected or len(history) != kept:
+            failures.append("locked writes (processes)")
+
+    if failures:
+        print("FAILED: records lost or duplicated by " + ", ".join(failures))
+        sys.exit(1)
+
+
+# Self-signed certificate for the local stand-in relays (needs the openssl CLI)
+def make_test_certificate(directory):
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-keyout", keyfile, "-out", certfile, "-subj", "/CN=localhost",
+         "-addext", "subjectAltName=DNS:localhost"],
+        check=True, capture_output=True
+    )
+    client_context = ssl.create_default_context(cafile=certfile)
+    return certfile, keyfile, client_context
+
+
+def _test_message(i):
+    from email.mime.text import MIMEText
+    msg = MIMEText(f"Benchmark message {i}", "plain")
+    msg["From"] = "bench@example.com"
+    msg["To"] = "to@example.com"
+    msg["Subject"] = f"Benchmark {i}"
+    return msg
+
+
+def _summary(samples):
+    samples = sorted(samples)
+    return {
+        "avg_ms": f"{sum(samples) / len(samples) * 1000:.1f}",
+        "p50_ms": f"{samples[len(samples) // 2] * 1000:.1f}",
+        "max_ms": f"{samples[-1] * 1000:.1f}",
+    }
+
+
+# Submit-to-accepted latency against a local STARTTLS relay whose replies are
+# delayed by --rtt seconds, comparing the old connect-per-send path with the
+# pooled, pre-warmed and TLS-resuming path
+def bench_smtp_latency(args):
+    from mailer import SMTPConnectionPool, send_message
+    from smtp_standin import StandInSMTPServer
+
+    with scratch_dir() as path:
+        certfile, keyfile, context = make_test_certificate(path)
+        server = StandInSMTPServer(delay=args.rtt, certfile=certfile, keyfile=keyfile).start()
+        host, port = "localhost", server.port
+        try:
+            # Before: connect, STARTTLS, AUTH, send and quit for every message
+            samples = []
+            for i in range(args.messages):
+                start = time.perf_counter()
+                smtp = smtplib.SMTP(host, port)
+                smtp.starttls(context=context)
+                smtp.login("bench@example.com", "secret")
+                smtp.sendmail("bench@example.com", ["to@example.com"], _test_message(i).as_string())
+                smtp.quit()
+                samples.append(time.perf_counter() - start)
+            report("connect per send (before)", messages=args.messages, **_summary(samples))
+
+            # Reconnect every time, but resume the previous TLS session
+            pool = SMTPConnectionPool(context=context)
+            resumed = 0
+            samples = []
+            for i in range(args.messages):
+                pool.close_all()
+                start = time.perf_counter()
+                send_message(pool, host, port, "bench@example.com", "secret",
+                             "bench@example.com", ["to@example.com"], _test_message(i))
+                samples.append(time.perf_counter() - start)
+                conn = pool.acquire(host, port, "bench@example.com", "secret")
+                resumed += conn.server.session_reused
+                pool.release(conn)
+            report("reconnect with TLS resumption", messages=args.messages,
+                   resumed=resumed, **_summary(samples))
+
+            # After: the session was pre-warmed when the page rendered
+            samples = []
+            for i in range(args.messages):
+                pool.close_all()
+                pool.prewarm(host, port, "bench@example.com", "secret")
+                time.sleep(args.think_time)
+                start = time.perf_counter()
+                send_message(pool, host, port, "bench@example.com", "secret",
+                             "bench@example.com", ["to@example.com"], _test_message(i))
+                samples.append(time.perf_counter() - start)
+            report("pre-warmed pooled session (after)", messages=args.messages, **_summary(samples))
+            pool.close_all()
+        finally:
+            server.stop()
+
+
+# Scheduling lag: how late due messages are released, and what idle pending
+# messages cost while they wait
+def bench_scheduler_lag(args):
+    from datetime import datetime, timedelta
+    from email.mime.text import MIMEText
+    import metrics
+    from scheduler import Scheduler
+
+    with scratch_dir():
+        delivered = []
+        scheduler = Scheduler(lambda job, password: delivered.append(job["id"]), poll_interval=3600).start()
+        msg = MIMEText("Scheduled benchmark message", "plain")
+
+        start = time.perf_counter()
+        far_future = datetime.now() + timedelta(days=30)
+        for i in range(args.idle):
+            scheduler.schedule(far_future + timedelta(seconds=i), "bench@example.com", ["to@example.com"], f"idle {i}", msg)
+        report("schedule", messages=args.idle, seconds=f"{time.perf_counter() - start:.2f}")
+
+        cpu_start = time.process_time()
+        time.sleep(args.idle_seconds)
+        report("idle pending", messages=args.idle, seconds=args.idle_seconds,
+               cpu_ms=f"{(time.process_time() - cpu_start) * 1000:.1f}",
+               heap_entries=len(scheduler._heap))
+
+        # Restart to load every pending job from disk, as after a deploy
+        scheduler.stop()
+        start = time.perf_counter()
+        scheduler = Scheduler(lambda job, password: delivered.append(job["id"]), poll_interval=3600).start()
+        report("reload pending", messages=len(scheduler._heap), seconds=f"{time.perf_counter() - start:.2f}")
+
+        # Everything is scheduled before the first message comes due, so the
+        # lag below is the scheduler's alone
+        metrics.reset()
+        first_due = datetime.now() + timedelta(seconds=args.lead)
+        for i in range(args.due):
+            due = first_due + timedelta(seconds=args.spread * i / args.due)
+            scheduler.schedule(due, "bench@example.com", ["to@example.com"], f"due {i}", msg)
+        if datetime.now() > first_due:
+            print("warning: scheduling took longer than --lead, lag includes insert time")
+        deadline = time.time() + args.spread + 60
+        while len(delivered) < args.due and time.time() < deadline:
+            time.sleep(0.05)
+        scheduler.stop()
+        lag = metrics.snapshot()["timings"].get("scheduler.lag", {})
+        report("due messages", delivered=len(delivered), batches=metrics.snapshot()["counters"].get("scheduler.batches"),
+               **{key: f"{value:.1f}" for key, value in lag.items() if key.endswith("_ms")})
+
+        # One message at a time with the app's poll interval, queued while
+        # the run loop and the heartbeat are both waiting
+        scheduler = Scheduler(lambda job, password: delivered.append(job["id"])).start()
+        lags = []
+        for i in range(args.single):
+            time.sleep(0.5)
+            metrics.reset()
+            count = len(delivered)
+            scheduler.schedule(datetime.now() + timedelta(seconds=1), "bench@example.com", ["to@example.com"],
+                               f"single {i}", msg)
+            deadline = time.time() + 60
+            while len(delivered) == count and time.time() < deadline:
+                time.sleep(0.01)
+            lag = metrics.snapshot()["timings"].get("scheduler.lag")
+            lags.append(lag["max_ms"] if lag else float("inf"))
+        scheduler.stop()
+        report("single messages", messages=args.single, max_lag_ms=f"{max(lags):.1f}")
+        if max(lags) > 1000:
+            print("FAILED: a single scheduled message was released more than a second late")
+            sys.exit(1)
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return "n/a"
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return f"{peak / (1024 * 1024 if sys.platform == 'darwin' else 1024):.0f}"
+
+
+def _bounce_message(message_id, recipient):
+    return (
+        "From MAILER-DAEMON Thu Jan  1 00:00:00 2026\n"
+        "From: MAILER-DAEMON@relay.example\n"
+        "Subject: Undelivered Mail Returned to Sender\n"
+        "MIME-Version: 1.0\n"
+        'Content-Type: multipart/report; report-type=delivery-status; boundary="b"\n\n'
+        "--b\nContent-Type: text/plain\n\nYour message could not be delivered.\n\n"
+        "--b\nContent-Type: message/delivery-status\n\n"
+        "Reporting-MTA: dns; relay.example\n\n"
+        f"Final-Recipient: rfc822; {recipient}\nAction: failed\nStatus: 5.1.1\n"
+        f"Diagnostic-Code: smtp; 550 5.1.1 <{recipient}>: No such user\n\n"
+        f"--b\nContent-Type: text/rfc822-headers\n\nMessage-ID: {message_id}\nSubject: Benchmark\n\n"
+        "--b--\n\n"
+    )
+
+
+# Bounce ingestion from a large mbox: the first run reads everything through
+# a memory map, later runs only read what was appended since
+def bench_bounce_ingest(args):
+    from bounces import BounceIngester
+    from history import append_history_records, make_history_record
+
+    with scratch_dir():
+        append_history_records([
+            make_history_record("bench@example.com", f"to{i}@example.com", f"Benchmark {i}", "SUCCESS",
+                                message_id=f"<bench{i}@example.com>")
+            for i in range(args.history)
+        ])
+        with open("bounces.mbox", "w") as f:
+            for i in range(args.messages):
+                sent = (i // args.match_every * 7919) % args.history
+                message_id = f"<bench{sent}@example.com>" if i % args.match_every == 0 else f"<other{i}@example.com>"
+                f.write(_bounce_message(message_id, f"to{sent}@example.com"))
+        size_mb = os.path.getsize("bounces.mbox") / (1024 * 1024)
+        rss_before = _peak_rss_mb()
+
+        start = time.perf_counter()
+        summary = BounceIngester(batch_size=args.batch_size).ingest("bounces.mbox")
+        elapsed = time.perf_counter() - start
+        report("full scan", mbox_mb=f"{size_mb:.0f}", seconds=f"{elapsed:.2f}",
+               messages_per_sec=f"{summary['messages'] / elapsed:.0f}", matched=summary["matched"],
+               peak_rss_mb_before=rss_before, peak_rss_mb_after=_peak_rss_mb())
+
+        start = time.perf_counter()
+        summary = BounceIngester(batch_size=args.batch_size).ingest("bounces.mbox")
+        report("rescan with nothing new", messages=summary["messages"],
+               ms=f"{(time.perf_counter() - start) * 1000:.1f}")
+
+        with open("bounces.mbox", "a") as f:
+            for i in range(args.appended):
+                f.write(_bounce_message(f"<bench{i % args.history}@example.com>", f"late{i}@example.com"))
+        start = time.perf_counter()
+        summary = BounceIngester(batch_size=args.batch_size).ingest("bounces.mbox")
+        report("incremental", messages=summary["messages"], matched=summary["matched"],
+               ms=f"{(time.perf_counter() - start) * 1000:.1f}")
+
+
+def _outbox_counts(path):
+    import sqlite3
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        return dict(conn.execute("SELECT status, COUNT(*) FROM scheduled GROUP BY status").fetchall())
+    finally:
+        conn.close()
+
+
+def _wait_for_workers(path, count, timeout=30):
+    import sqlite3
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        conn = sqlite3.connect(path, timeout=30)
+        try:
+            live = conn.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+        except sqlite3.OperationalError:
+            live = 0
+        finally:
+            conn.close()
+        if live >= count:
+            return
+        time.sleep(0.05)
+    raise RuntimeError("Outbox workers did not start")
+
+
+# Delivery throughput of the shared outbox as worker processes are added,
+# against a local relay whose replies are delayed by --rtt seconds, and a
+# crash run in which one worker is killed while it holds leased jobs
+def bench_outbox_workers(args):
+    from datetime import datetime
+    from scheduler import Scheduler
+    from smtp_standin import StandInSMTPServer
+    from worker import run_worker
+
+    def run(workers, lease_seconds=60, kill_after=None):
+        server = StandInSMTPServer(delay=args.rtt).start()
+        path = os.path.abspath(f"outbox-{workers}-{kill_after}.db")
+        outbox = Scheduler(deliver=None, path=path)
+        # One event per worker: setting an event a killed process was
+        # waiting on would block forever
+        stops = [multiprocessing.Event() for _ in range(workers)]
+        processes = [
+            multiprocessing.Process(target=run_worker, kwargs=dict(
+                sender="bench@example.com", password="secret", path=path,
+                relays=[{"name": "standin", "host": "localhost", "port": server.port, "starttls": False}],
+                batch_size=args.batch_size, poll_interval=args.poll_interval, lease_seconds=lease_seconds,
+                stop_event=stop))
+            for stop in stops
+        ]
+        try:
+            for process in processes:
+                process.start()
+            _wait_for_workers(path, workers)
+
+            start = time.perf_counter()
+            now = datetime.now()
+            for i in range(args.messages):
+                outbox.schedule(now, "bench@example.com", ["to@example.com"], f"Benchmark {i}", _test_message(i),
+                                deliver_here=False)
+            killed = False
+            deadline = time.time() + 600
+            while time.time() < deadline:
+                if kill_after is not None and not killed and time.perf_counter() - start >= kill_after:
+                    processes[0].kill()
+                    killed = True
+                if _outbox_counts(path).get("sent", 0) >= args.messages:
+                    break
+                time.sleep(0.05)
+            elapsed = time.perf_counter() - start
+        finally:
+            for process, stop in zip(processes, stops):
+                if process.is_alive():
+                    stop.set()
+                process.join()
+            outbox.stop()
+            server.stop()
+        return elapsed, _outbox_counts(path), server.accepted
+
+    with scratch_dir():
+        baseline = None
+        for workers in [int(count) for count in args.workers.split(",")]:
+            elapsed, counts, accepted = run(workers)
+            rate = args.messages / elapsed
+            baseline = baseline or rate
+            report(f"{workers} workers", messages=args.messages, sent=counts.get("sent", 0),
+                   seconds=f"{elapsed:.2f}", messages_per_sec=f"{rate:.1f}", speedup=f"{rate / baseline:.2f}x")
+
+        # One of two workers is killed mid-run; its leased jobs must be
+        # picked up by the other once the lease runs out
+        elapsed, counts, accepted = run(2, lease_seconds=args.crash_lease, kill_after=args.crash_after)
+        report("2 workers, one killed", messages=args.messages, sent=counts.get("sent", 0),
+               relay_accepted=accepted, resent=accepted - args.messages, seconds=f"{elapsed:.2f}")
+
+
+_BENCH_STATUSES = ["SUCCESS"] * 17 + ["FAILED", "BOUNCED", "SUPPRESSED"]
+
+
+def _bench_history_record(i, senders):
+    from history import make_history_record
+
+    status = _BENCH_STATUSES[i % len(_BENCH_STATUSES)]
+    return make_history_record(f"sender{i % senders}@example.com", f"to{i}@example.com", f"Campaign {i % 500}",
+                               status, None if status == "SUCCESS" else "550 5.1.1 No such user",
+                               message_id=f"<{i}.bench@example.com>")
+
+
+def _write_history(records, senders):
+    from history import append_history_records
+
+    for batch_start in range(0, records, 100000):
+        append_history_records([
+            _bench_history_record(i, senders) for i in range(batch_start, min(batch_start + 100000, records))
+        ])
+
+
+# A year of search-index records, oldest first; every tenth subject mentions an invoice
+def _search_records(count):
+    from datetime import datetime, timedelta
+
+    start = datetime(2025, 1, 1)
+    step = timedelta(days=365) / count
+    statuses = _BENCH_STATUSES + ["TEST"]
+    for i in range(count):
+        status = statuses[i % len(statuses)]
+        yield {
+            "timestamp": (start + step * i).strftime("%Y-%m-%d %H:%M:%S"),
+            "sender": f"sender{i % 20}@example.com",
+            "recipients": f"to{i}@example{i % 100}.com",
+            "subject": f"Invoice {i} for March" if i % 10 == 0 else f"Campaign {i % 500} newsletter",
+            "status": status,
+            "error": None if status == "SUCCESS" else "550 5.1.1 No such user",
+        }
+
+
+# The index before timestamp and status had their own indexed columns: both
+# were UNINDEXED FTS columns checked row by row against every term match
+def _legacy_search(conn, query, start_date, end_date, statuses, limit=500):
+    sql = ("SELECT timestamp, sender, recipients, subject, status, error FROM history_fts "
+           "WHERE history_fts MATCH ? AND substr(timestamp, 1, 10) >= ? AND substr(timestamp, 1, 10) <= ?")
+    params = [query, start_date, end_date]
+    if statuses:
+        sql += f" AND status IN ({', '.join('?' * len(statuses))})"
+        params += statuses
+    return conn.execute(sql + " ORDER BY rowid DESC LIMIT ?", params + [limit]).fetchall()
+
+
+# Searches with the date range and status filters the History page always sends
+def bench_history_search(args):
+    import sqlite3
+    import history_index
+
+    cases = [
+        ("invoice, one day, TEST only", "invoice", "2025-06-15", "2025-06-15", ["TEST"]),
+        ("phrase, one month", "campaign 12", "2025-06-01", "2025-06-30", None),
+        ("invoice, whole year", "invoice", "2025-01-01", "2025-12-31", None),
+    ]
+    with scratch_dir():
+        start = time.perf_counter()
+        history_index.build_index(_search_records(args.records))
+        report("index build", records=args.records, seconds=f"{time.perf_counter() - start:.2f}")
+
+        legacy = sqlite3.connect("legacy_index.db")
+        legacy.execute("CREATE VIRTUAL TABLE history_fts USING fts5("
+                       "subject, recipients, sender, error, timestamp UNINDEXED, status UNINDEXED)")
+        with legacy:
+            legacy.executemany(
+                "INSERT INTO history_fts VALUES (?, ?, ?, ?, ?, ?)",
+                ((r["subject"], r["recipients"], r["sender"], r["error"] or "", r["timestamp"], r["status"])
+                 for r in _search_records(args.records))
+            )
+
+        for name, text, start_date, end_date, statuses in cases:
+            for variant, search in (
+                ("before", lambda: _legacy_search(legacy, history_index._build_query(text),
+                                                  start_date, end_date, statuses)),
+                ("after", lambda: history_index.search(text, start_date, end_date, statuses)),
+            ):
+                samples = []
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    results = search()
+                    samples.append(time.perf_counter() - started)
+                report(f"{name} ({variant})", results=len(results), **_summary(samples))
+        legacy.close()
+
+
+# The History page before the columnar frame: a list of dicts turned into
+# object columns, with a badge rendered for every record
+def _legacy_history_frame():
+    import pandas as pd
+    from history import load_history
+
+    df = pd.DataFrame(load_history())
+    badges = {"SUCCESS": "<span class='status-badge status-success'>Success</span>",
+              "FAILED": "<span class='status-badge status-failed'>Failed</span>"}
+    df['formatted_status'] = df['status'].apply(lambda status: badges.get(status, status))
+    return df
+
+
+def _load_history_frame(variant, results):
+    from history import iter_history
+    from history_frame import build_history_frame, history_page, status_badge
+
+    start = time.perf_counter()
+    if variant == "list of dicts":
+        frame = _legacy_history_frame()
+    else:
+        frame = build_history_frame(iter_history())
+        badges = [status_badge(status) for status in history_page(frame, 1)["status"]]
+    load_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    filtered = frame[frame["status"].isin(["FAILED", "BOUNCED"])]
+    filter_ms = (time.perf_counter() - start) * 1000
+    results.put((variant, load_seconds, filter_ms, len(filtered),
+                 frame.memory_usage(deep=True).sum() / (1024 * 1024), _peak_rss_mb()))
+
+
+# Memory and load time of the History page data for a large history. Each
+# variant is loaded in a fresh process so that peak RSS is its own.
+def bench_history_frame(args):
+    with scratch_dir():
+        _write_history(args.records, args.senders)
+        size_mb = os.path.getsize("email_history.jsonl") / (1024 * 1024)
+        report("history", records=args.records, file_mb=f"{size_mb:.0f}")
+
+        results = multiprocessing.Queue()
+        for variant in ("columnar", "list of dicts"):
+            process = multiprocessing.Process(target=_load_history_frame, args=(variant, results))
+            process.start()
+            name, load_seconds, filter_ms, matched, frame_mb, peak_rss = results.get()
+            process.join()
+            report(name, load_seconds=f"{load_seconds:.2f}", filter_ms=f"{filter_ms:.1f}", matched=matched,
+                   frame_mb=f"{frame_mb:.0f}", peak_rss_mb=peak_rss)
+
+
+# What a History page rerun does with the default filters: this month's
+# records with every status, and the badges of the first page
+def _history_page_rerun(cache):
+    from datetime import date
+    from history_frame import history_page, select_statuses, status_badge
+
+    today = date.today()
+    frame = select_statuses(cache.frame(today.replace(day=1), today), ["SUCCESS", "FAILED", "BOUNCED", "SUPPRESSED"])
+    badges = [status_badge(status) for status in history_page(frame, 1)["status"]]
+    return frame
+
+
+# History page reruns against a large history: the first load parses the
+# whole active file, later ones only what was appended in between
+def bench_history_reruns(args):
+    from history import append_history_records, update_history_records
+    from history_frame import HistoryFrameCache
+
+    with scratch_dir():
+        _write_history(args.records, args.senders)
+        cache = HistoryFrameCache()
+        start = time.perf_counter()
+        frame = _history_page_rerun(cache)
+        report("first load", records=len(frame), seconds=f"{time.perf_counter() - start:.2f}")
+
+        samples = []
+        for i in range(args.reruns):
+            start = time.perf_counter()
+            _history_page_rerun(cache)
+            samples.append(time.perf_counter() - start)
+        report("rerun, nothing appended", **_summary(samples))
+
+        samples = []
+        for i in range(args.reruns):
+            append_history_records([_bench_history_record(args.records + i, args.senders)])
+            start = time.perf_counter()
+            frame = _history_page_rerun(cache)
+            samples.append(time.perf_counter() - start)
+        report("rerun after one append", records=len(frame), **_summary(samples))
+
+        update_history_records({"<0.bench@example.com>": lambda record: record.update(status="BOUNCED") is None})
+        start = time.perf_counter()
+        frame = _history_page_rerun(cache)
+        report("rerun after the file was rewritten", records=len(frame),
+               seconds=f"{time.perf_counter() - start:.2f}")
+
+        # The page before the cache: every rerun parses the whole file again
+        from history import iter_history
+        from history_frame import build_history_frame
+        start = time.perf_counter()
+        build_history_frame(iter_history())
+        report("rerun without the cache", seconds=f"{time.perf_counter() - start:.2f}")
+
+
+# Sending through three relays: a fast one, a slow one (--slow-rtt) and one
+# that is not listening at all. A plain rotation that only fails over on
+# errors is compared with the router's probes and latency-weighted choice,
+# and the router is run again while the fast relay throttles every sender.
+def bench_relay_failover(args):
+    import itertools
+    import socket
+    from mailer import SMTPConnectionPool, send_message
+    from relays import RelayRouter, fails_over
+    from smtp_standin import StandInSMTPServer
+
+    fast = StandInSMTPServer(delay=args.rtt).start()
+    slow = StandInSMTPServer(delay=args.slow_rtt).start()
+    # A port nobody listens on: connections are refused
+    unused = socket.socket()
+    unused.bind(("localhost", 0))
+    down_port = unused.getsockname()[1]
+    unused.close()
+    table = [
+        {"name": "down", "host": "localhost", "port": down_port, "starttls": False},
+        {"name": "slow", "host": "localhost", "port": slow.port, "starttls": False},
+        {"name": "fast", "host": "localhost", "port": fast.port, "starttls": False},
+    ]
+
+    def run(name, send):
+        accepted = fast.accepted, slow.accepted
+        failed = 0
+        samples = []
+        start = time.perf_counter()
+        for i in range(args.messages):
+            sent_at = time.perf_counter()
+            try:
+                send(_test_message(i))
+            except Exception:
+                failed += 1
+            samples.append(time.perf_counter() - sent_at)
+        elapsed = time.perf_counter() - start
+        report(name, messages=args.messages, failed=failed, via_fast=fast.accepted - accepted[0],
+               via_slow=slow.accepted - accepted[1], messages_per_sec=f"{args.messages / elapsed:.1f}",
+               **_summary(samples))
+
+    try:
+        pool = SMTPConnectionPool(timeout=10)
+        rotation = itertools.count()
+
+        def rotate(msg):
+            first = next(rotation)
+            for attempt in range(len(table)):
+                relay = table[(first + attempt) % len(table)]
+                try:
+                    return send_message(pool, relay["host"], relay["port"], "bench@example.com", "secret",
+                                        "bench@example.com", ["to@example.com"], msg, starttls=False)
+                except Exception as e:
+                    if attempt == len(table) - 1 or not fails_over(e):
+                        raise
+
+        run("rotation with failover (before)", rotate)
+        pool.close_all()
+
+        router = RelayRouter(table, SMTPConnectionPool(timeout=10), probe_interval=args.probe_interval)
+        router.probe_all()
+        router.start()
+
+        def route(msg):
+            return router.send_message("bench@example.com", "secret", "bench@example.com", ["to@example.com"], msg)
+
+        run("router (after)", route)
+        fast.throttled = True
+        run("router, fast relay throttled", route)
+        fast.throttled = False
+        router.stop()
+        router.pool.close_all()
+    finally:
+        fast.stop()
+        slow.stop()
+
+
+_NEWSLETTER_TEMPLATE = """<html><head><style>p { font-family: sans-serif; }</style></head><body>
+<h1>Hello {{ first_name or "there" }},</h1>
+<p>Thanks for shopping with us. Your order #{{ order.id }} of {{ order.items }} items
+({{ order.total }}) {% if order.shipped %}has shipped{% else %}is being packed{% endif %}.</p>
+{% if vip %}
+<p>As a <b>VIP member</b> you get {{ discount or 10 }}% off your next order with the code
+<b>{{ code }}</b>.</p>
+{% elif not order.id %}
+<p>You have not ordered anything yet, so here is a welcome gift: <b>{{ code }}</b>.</p>
+{% endif %}
+<ul>
+<li>Track your parcel at <a href="{{ tracking_url }}">the tracking page</a></li>
+<li>Change your delivery address under <a href="https://shop.example.com/account">your account</a></li>
+<li>Returns are free for 30 days</li>
+</ul>
+{% include "footer" %}
+</body></html>"""
+_FOOTER_PARTIAL = """<p>-- <br>The {{ shop or "Example Shop" }} team<br>
+<a href="https://shop.example.com/unsubscribe?u={{ user_id }}">Unsubscribe</a></p>"""
+
+
+# Personalized bodies per second: compiling the template for every body and
+# converting each rendered body to text, against the cached compiled template
+# and its compiled text version, and the same with the MIME part built
+def bench_template_render(args):
+    import random
+    from templates import CompiledTemplate, compile_template, html_to_text
+
+    contexts = [
+        {
+            "first_name": f"Customer {i}" if i % 5 else None,
+            "order": {"id": i if i % 7 else None, "items": i % 9 + 1, "total": f"${i % 500}.99",
+                      "shipped": i % 2 == 0},
+            "vip": i % 3 == 0,
+            "discount": random.choice([None, 15, 20]),
+            "code": f"SAVE{i:06d}",
+            "tracking_url": f"https://track.example.com/{i}",
+            "user_id": i,
+        }
+        for i in range(args.bodies)
+    ]
+    partials = {"footer": _FOOTER_PARTIAL}
+
+    def run(name, render):
+        start = time.perf_counter()
+        for context in contexts:
+            render(context)
+        elapsed = time.perf_counter() - start
+        report(name, bodies=args.bodies, bodies_per_sec=f"{args.bodies / elapsed:.0f}",
+               us_per_body=f"{elapsed / args.bodies * 1e6:.1f}")
+
+    def compile_every_time(context):
+        body = CompiledTemplate(_NEWSLETTER_TEMPLATE).render(context, partials)
+        return body, html_to_text(body)
+
+    def cached(context):
+        template = compile_template(_NEWSLETTER_TEMPLATE)
+        return template.render(context, partials), template.render_text(context, partials)
+
+    run("compile and convert every body (before)", compile_every_time)
+    run("cached template, HTML and text (after)", cached)
+    run("cached template, HTML only", lambda context: compile_template(_NEWSLETTER_TEMPLATE).render(context, partials))
+    run("cached template, MIME part", lambda context: compile_template(_NEWSLETTER_TEMPLATE).render_part(context, partials).as_bytes())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Email tooling benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    writers_parser = subparsers.add_parser("history-writers", help="Concurrent history writers stress test")
+    writers_parser.add_argument("--writers", type=int, default=50)
+    writers_parser.add_argument("--records", type=int, default=200)
+    writers_parser.add_argument("--processes", type=int, default=8)
+    writers_parser.add_argument("--flush-interval", type=float, default=0.2)
+    writers_parser.set_defaults(func=bench_history_writers)
+
+    latency_parser = subparsers.add_parser("smtp-latency", help="Submit-to-accepted latency against a local relay")
+    latency_parser.add_argument("--messages", type=int, default=20)
+    latency_parser.add_argument("--rtt", type=float, default=0.02,
+                                help="Delay added before every relay reply, in seconds")
+    latency_parser.add_argument("--think-time", type=float, default=0.5,
+                                help="Time between page render and submit, in seconds")
+    latency_parser.set_defaults(func=bench_smtp_latency)
+
+    lag_parser = subparsers.add_parser("scheduler-lag", help="Scheduled message release lag")
+    lag_parser.add_argument("--idle", type=int, default=50000, help="Messages pending far in the future")
+    lag_parser.add_argument("--idle-seconds", type=float, default=5)
+    lag_parser.add_argument("--due", type=int, default=20000, help="Messages becoming due during the run")
+    lag_parser.add_argument("--spread", type=float, default=10, help="Seconds over which due messages are spread")
+    lag_parser.add_argument("--lead", type=float, default=10, help="Seconds until the first message is due")
+    lag_parser.add_argument("--single", type=int, default=5, help="Messages queued one at a time at the end")
+    lag_parser.set_defaults(func=bench_scheduler_lag)
+
+    bounce_parser = subparsers.add_parser("bounce-ingest", help="Bounce ingestion from a large mbox")
+    bounce_parser.add_argument("--messages", type=int, default=200000, help="Bounce messages in the mbox")
+    bounce_parser.add_argument("--history", type=int, default=10000, help="Sent emails in the history")
+    bounce_parser.add_argument("--match-every", type=int, default=100,
+                               help="One bounce in this many refers to an email in the history")
+    bounce_parser.add_argument("--appended", type=int, default=100, help="Bounces arriving after the first run")
+    bounce_parser.add_argument("--batch-size", type=int, default=1000)
+    bounce_parser.set_defaults(func=bench_bounce_ingest)
+
+    outbox_parser = subparsers.add_parser("outbox-workers", help="Outbox delivery throughput per worker count")
+    outbox_parser.add_argument("--messages", type=int, default=2000)
+    outbox_parser.add_argument("--workers", default="1,2,4,8", help="Comma separated worker counts to run")
+    outbox_parser.add_argument("--rtt", type=float, default=0.005,
+                               help="Delay added before every relay reply, in seconds")
+    outbox_parser.add_argument("--batch-size", type=int, default=10)
+    outbox_parser.add_argument("--poll-interval", type=float, default=0.2)
+    outbox_parser.add_argument("--crash-lease", type=float, default=3,
+                               help="Lease length in the crash run, in seconds")
+    outbox_parser.add_argument("--crash-after", type=float, default=1,
+                               help="Seconds into the crash run at which a worker is killed")
+    outbox_parser.set_defaults(func=bench_outbox_workers)
+
+    frame_parser = subparsers.add_parser("history-frame", help="History page memory and load time")
+    frame_parser.add_argument("--records", type=int, default=1000000)
+    frame_parser.add_argument("--senders", type=int, default=5, help="Distinct sender accounts")
+    frame_parser.set_defaults(func=bench_history_frame)
+
+    reruns_parser = subparsers.add_parser("history-reruns", help="History page rerun time with the frame cache")
+    reruns_parser.add_argument("--records", type=int, default=1000000)
+    reruns_parser.add_argument("--senders", type=int, default=5, help="Distinct sender accounts")
+    reruns_parser.add_argument("--reruns", type=int, default=50)
+    reruns_parser.set_defaults(func=bench_history_reruns)
+
+    search_parser = subparsers.add_parser("history-search", help="History search with date and status filters")
+    search_parser.add_argument("--records", type=int, default=1000000)
+    search_parser.add_argument("--repeat", type=int, default=5)
+    search_parser.set_defaults(func=bench_history_search)
+
+    relay_parser = subparsers.add_parser("relay-failover", help="Relay routing with a slow and a dead relay")
+    relay_parser.add_argument("--messages", type=int, default=300)
+    relay_parser.add_argument("--rtt", type=float, default=0.005,
+                              help="Delay before every reply of the fast relay, in seconds")
+    relay_parser.add_argument("--slow-rtt", type=float, default=0.2,
+                              help="Delay before every reply of the slow relay, in seconds")
+    relay_parser.add_argument("--probe-interval", type=float, default=2)
+    relay_parser.set_defaults(func=bench_relay_failover)
+
+    template_parser = subparsers.add_parser("template-render", help="Personalized body rendering throughput")
+    template_parser.add_argument("--bodies", type=int, default=20000)
+    template_parser.set_defaults(func=bench_template_render)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import binascii
+import json
+import mmap
+import os
+import quopri
+import re
+
+import metrics
+from history import update_history_records
+
+# Incremental ingestion of bounce messages (DSN reports, RFC 3464) from a
+# local mbox file or maildir. Each bounce is matched to the history records
+# of the original message by its Message-ID, which the app sets on every
+# message it sends. The position reached in every mailbox is kept in
+# STATE_FILE, so each run only reads what arrived since the last one.
+STATE_FILE = "bounce_state.json"
+DEFAULT_BATCH_SIZE = 1000
+
+# Pages of the mbox mapping that were read are released every this many bytes
+RELEASE_BYTES = 64 * 1024 * 1024
+
+_REPLY_CODE = re.compile(r"\b([245]\d\d)\b")
+_MESSAGE_ID_HEADER = re.compile(rb"^Message-ID:\s*(<[^>\r\n]+>)", re.IGNORECASE | re.MULTILINE)
+_HEADER_END = re.compile(rb"\r?\n\r?\n")
+_BLOCK_SEPARATOR = re.compile(rb"\r?\n[ \t]*\r?\n")
+# A header field with its folded continuation lines
+_FIELD = re.compile(rb"^([!-9;-~]+):[ \t]*(.*(?:\r?\n[ \t].*)*)", re.MULTILINE)
+_BOUNDARY = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+
+
+def _normalize_message_id(message_id):
+    if not message_id:
+        return None
+    message_id = message_id.strip()
+    if not message_id.startswith("<"):
+        message_id = f"<{message_id}>"
+    return message_id
+
+
+# Strip the type from a typed field, e.g. "rfc822; user@example.com"
+def _typed_value(value):
+    return " ".join(str(value or "").split(";", 1)[-1].split())
+
+
+def _field_address(value):
+    return _typed_value(value).strip("<>").lower()
+
+
+# Split a header section from the body that follows the first blank line
+def _split_headers(data):
+    data = b"\n" + data
+    match = _HEADER_END.search(data)
+    if match is None:
+        return data[1:], b""
+    return data[1:match.start()], data[match.end():]
+
+
+# Unfolded header fields of a block by lower-case name; the first one wins
+def _fields(block):
+    fields = {}
+    for name, value in _FIELD.findall(block):
+        fields.setdefault(name.decode("ascii").lower(), " ".join(value.decode("utf-8", "replace").split()))
+    return fields
+
+
+def _content_type(fields):
+    return fields.get("content-type", "text/plain").split(";", 1)[0].strip().lower()
+
+
+def _decode_part(fields, body):
+    encoding = fields.get("content-transfer-encoding", "").lower()
+    if encoding == "base64":
+        return binascii.a2b_base64(body)
+    if encoding == "quoted-printable":
+        return quopri.decodestring(body)
+    return body
+
+
+# Function to parse a DSN into {"message_id": ..., "failures": [...]} with one
+# {"recipient", "status", "diagnostic"} entry per failed recipient. Returns
+# None for messages that are not delivery failure reports. Only the parts a
+# report consists of are looked at, which makes this several times faster
+# than a full parse with the email package on large mailboxes.
+def parse_dsn(data):
+    headers, body = _split_headers(data)
+    fields = _fields(headers)
+    if _content_type(fields) != "multipart/report":
+        return None
+    boundary = _BOUNDARY.search(fields["content-type"])
+    if boundary is None:
+        return None
+    delimiter = b"\n--" + boundary.group(1).strip().encode()
+
+    message_id = None
+    failures = []
+    for part in (b"\n" + body).split(delimiter)[1:]:
+        if part.startswith(b"--"):
+            break
+        # Skip the rest of the delimiter line
+        part_headers, part_body = _split_headers(part.split(b"\n", 1)[-1])
+        part_fields = _fields(part_headers)
+        content_type = _content_type(part_fields)
+        if content_type == "message/delivery-status":
+            blocks = _BLOCK_SEPARATOR.split(_decode_part(part_fields, part_body).strip())
+            # The first block holds per-message fields, the rest one recipient each
+            for block in blocks[1:]:
+                recipient_fields = _fields(block)
+                if recipient_fields.get("action", "").lower() != "failed":
+                    continue
+                failures.append({
+                    "recipient": _field_address(recipient_fields.get("final-recipient")
+                                                or recipient_fields.get("original-recipient")),
+                    "status": recipient_fields.get("status", ""),
+                    "diagnostic": _typed_value(recipient_fields.get("diagnostic-code")),
+                })
+        elif content_type in ("message/rfc822", "text/rfc822-headers") and message_id is None:
+            original_headers, _ = _split_headers(_decode_part(part_fields, part_body).lstrip(b"\r\n"))
+            message_id = _normalize_message_id(_fields(original_headers).get("message-id"))
+    if message_id is None:
+        # Some relays inline the original headers in a text part instead
+        match = _MESSAGE_ID_HEADER.search(body)
+        if match:
+            message_id = _normalize_message_id(match.group(1).decode("ascii", "replace"))
+    if not failures or not message_id:
+        return None
+    return {"message_id": message_id, "failures": failures}
+
+
+def _describe_failure(failure):
+    details = failure["diagnostic"] or failure["status"]
+    return f"{failure['recipient']} ({details})"
+
+
+# Build the history update for one message: the delivered record becomes
+# BOUNCED and lists every recipient that bounced
+def _bounce_update(failures):
+    def update(record):
+        if record.get("status") not in ("SUCCESS", "BOUNCED"):
+            return False
+        bounced = record.get("bounced") or []
+        new = [failure for failure in failures if failure["recipient"] not in bounced]
+        if not new:
+            return False
+        descriptions = "; ".join(_describe_failure(failure) for failure in new)
+        if record.get("status") == "BOUNCED" and record.get("error"):
+            record["error"] += "; " + descriptions
+        else:
+            record["error"] = "Bounced: " + descriptions
+        record["status"] = "BOUNCED"
+        record["bounced"] = bounced + [failure["recipient"] for failure in new]
+        return True
+    return update
+
+
+# Yield (message bytes, offset after the message) for every complete message
+# in an mbox from offset on. The file is memory-mapped, so only the message
+# being parsed is ever copied into memory, and pages already read are handed
+# back to the OS as we go, however large the mbox is.
+def _iter_mbox(path, offset):
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= offset:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            released = offset - offset % mmap.PAGESIZE
+            start = offset
+            while start < size:
+                separator = mm.find(b"\nFrom ", start)
+                if separator == -1:
+                    # The last message is only complete once its writer has
+                    # ended it with the blank line that precedes the next one
+                    tail = mm[max(start, size - 4):size]
+                    if not (tail.endswith(b"\n\n") or tail.endswith(b"\r\n\r\n")):
+                        return
+                    end = size
+                else:
+                    end = separator + 1
+                data = mm[start:end]
+                # Drop the "From sender date" envelope line
+                yield data[data.find(b"\n") + 1:], end
+                start = end
+                if end - released >= RELEASE_BYTES and hasattr(mmap, "MADV_DONTNEED"):
+                    page_start = end - end % mmap.PAGESIZE
+                    mm.madvise(mmap.MADV_DONTNEED, released, page_start - released)
+                    released = page_start
+
+
+class BounceIngester:
+    def __init__(self, state_path=STATE_FILE, suppression_list=None, batch_size=DEFAULT_BATCH_SIZE):
+        self.state_path = state_path
+        self.suppression_list = suppression_list
+        self.batch_size = batch_size
+        try:
+            with open(self.state_path, "r") as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+        self.state.setdefault("mbox", {})
+        self.state.setdefault("maildir", {})
+        self._pending = {}
+        self.summary = {"messages": 0, "bounces": 0, "matched": 0, "unmatched": 0}
+
+    def _save_state(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _handle(self, data):
+        self.summary["messages"] += 1
+        try:
+            report = parse_dsn(data)
+        except Exception:
+            report = None
+        if report is None:
+            return
+        self.summary["bounces"] += 1
+        metrics.increment("bounces.ingested")
+        self._pending.setdefault(report["message_id"], []).extend(report["failures"])
+        if self.suppression_list is not None:
+            for failure in report["failures"]:
+                if failure["status"].startswith("5") and failure["recipient"]:
+                    code = _REPLY_CODE.search(failure["diagnostic"])
+                    self.suppression_list.add(failure["recipient"], int(code.group(1)) if code else None,
+                                              _describe_failure(failure))
+
+    # Apply the collected bounces to the history, then record how far we got
+    def _flush(self):
+        if self._pending:
+            found = update_history_records({
+                message_id: _bounce_update(failures) for message_id, failures in self._pending.items()
+            })
+            self.summary["matched"] += len(found)
+            self.summary["unmatched"] += len(self._pending) - len(found)
+            metrics.increment("bounces.matched", len(found))
+            self._pending = {}
+        self._save_state()
+
+    # Function to ingest new messages from an mbox file or a maildir
+    def ingest(self, path):
+        if os.path.isdir(path):
+            self._ingest_maildir(path)
+        else:
+            self._ingest_mbox(path)
+        return self.summary
+
+    def _ingest_mbox(self, path):
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        position = self.state["mbox"].get(key, {})
+        offset = position.get("offset", 0)
+        # A replaced or truncated mailbox is read again from the start
+        if position.get("inode") != stat.st_ino or stat.st_size < offset:
+            offset = 0
+        self.state["mbox"][key] = {"offset": offset, "inode": stat.st_ino}
+        since_flush = 0
+        for data, end in _iter_mbox(path, offset):
+            self._handle(data)
+            self.state["mbox"][key]["offset"] = end
+            since_flush += 1
+            if since_flush >= self.batch_size:
+                self._flush()
+                since_flush = 0
+        self._flush()
+
+    # Maildir messages are one file each; a file is identified by its unique
+    # name without the ":2,<flags>" info suffix, which changes when mail is read
+    def _ingest_maildir(self, path):
+        key = os.path.abspath(path)
+        processed = set(self.state["maildir"].get(key, []))
+        seen = set()
+        since_flush = 0
+        for subdir in ("new", "cur"):
+            directory = os.path.join(path, subdir)
+            if not os.path.isdir(directory):
+                continue
+            for name in sorted(os.listdir(directory)):
+                unique = name.split(":", 1)[0]
+                seen.add(unique)
+                if unique in processed:
+                    continue
+                try:
+                    with open(os.path.join(directory, name), "rb") as f:
+                        data = f.read()
+                except OSError:
+                    # Moved between new/ and cur/ while we were listing
+                    continue
+                self._handle(data)
+                processed.add(unique)
+                since_flush += 1
+                if since_flush >= self.batch_size:
+                    self.state["maildir"][key] = sorted(processed)
+                    self._flush()
+                    since_flush = 0
+        # Names of deleted messages are forgotten so the state stays small
+        self.state["maildir"][key] = sorted(processed & seen)
+        self._flush()
@@ -0,0 +1,464 @@
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+import history_index
+
+# The current month is kept in an append-only JSON Lines file. Older months
+# are rotated out into gzip-compressed segments, one per month, so the file
+# that is read and written on every send stays small while the full audit
+# trail is kept on disk.
+HISTORY_FILE = "email_history.jsonl"
+LEGACY_HISTORY_FILE = "email_history.json"
+ARCHIVE_DIR = "history_archive"
+ARCHIVE_PREFIX = "email_history-"
+ARCHIVE_SUFFIX = ".jsonl.gz"
+LOCK_FILE = "email_history.lock"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+_MESSAGE_ID_FIELD = re.compile(r'"message_id": ("(?:[^"\\]|\\.)*")')
+
+logger = logging.getLogger(__name__)
+
+
+# Exclusive OS-level lock around every change to the history files, so that
+# several processes (or Streamlit sessions) never interleave their writes
+@contextmanager
+def _history_lock():
+    with open(LOCK_FILE, "a") as f:
+        if os.name == "nt":
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+# Month ("YYYY-MM") a record belongs to
+def _record_month(record):
+    return str(record.get("timestamp", ""))[:7]
+
+
+def _archive_path(month):
+    return os.path.join(ARCHIVE_DIR, f"{ARCHIVE_PREFIX}{month}{ARCHIVE_SUFFIX}")
+
+
+# Yield the records of a JSON Lines stream, skipping damaged lines
+def _iter_jsonl(f):
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue
+
+
+def _write_jsonl(f, records):
+    for record in records:
+        f.write(json.dumps(record) + "\n")
+
+
+# Months that have a closed, compressed segment on disk
+def list_archive_months():
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    months = []
+    for name in os.listdir(ARCHIVE_DIR):
+        if name.startswith(ARCHIVE_PREFIX) and name.endswith(ARCHIVE_SUFFIX):
+            months.append(name[len(ARCHIVE_PREFIX):-len(ARCHIVE_SUFFIX)])
+    return sorted(months)
+
+
+# Move records from the old single JSON array file into the segmented layout
+def _migrate_legacy_history():
+    if not os.path.exists(LEGACY_HISTORY_FILE):
+        return
+    with _history_lock():
+        if os.path.exists(LEGACY_HISTORY_FILE):
+            _migrate_legacy_history_locked()
+
+
+def _migrate_legacy_history_locked():
+    try:
+        with open(LEGACY_HISTORY_FILE, "r") as f:
+            records = json.load(f)
+    except (OSError, ValueError):
+        records = []
+    with open(HISTORY_FILE, "a") as f:
+        _write_jsonl(f, records)
+    os.replace(LEGACY_HISTORY_FILE, LEGACY_HISTORY_FILE + ".bak")
+    _rotate_history_locked(datetime.now())
+
+
+# Month of the oldest record in the active file, read from its first line only
+def _active_month():
+    if not os.path.exists(HISTORY_FILE):
+        return None
+    with open(HISTORY_FILE, "r") as f:
+        for record in _iter_jsonl(f):
+            return _record_month(record)
+    return None
+
+
+# Close every month older than the current one into its compressed segment
+def rotate_history(now=None):
+    with _history_lock():
+        _rotate_history_locked(now or datetime.now())
+
+
+def _rotate_history_locked(now):
+    current_month = now.strftime("%Y-%m")
+    if not os.path.exists(HISTORY_FILE):
+        return
+    with open(HISTORY_FILE, "r") as f:
+        records = list(_iter_jsonl(f))
+
+    closed = {}
+    keep = []
+    for record in records:
+        month = _record_month(record)
+        if month and month < current_month:
+            closed.setdefault(month, []).append(record)
+        else:
+            keep.append(record)
+    if not closed:
+        return
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    for month, month_records in closed.items():
+        # gzip members can be concatenated, so late records for a month that
+        # is already archived are simply appended as a new member
+        with gzip.open(_archive_path(month), "at") as f:
+            _write_jsonl(f, month_records)
+
+    tmp_path = HISTORY_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        _write_jsonl(f, keep)
+    os.replace(tmp_path, HISTORY_FILE)
+
+
+# Stream history records one at a time, reading only the segments that
+# overlap the requested date range (dates are datetime.date or "YYYY-MM-DD"
+# strings) and optionally keeping only the given statuses
+def iter_history(start_date=None, end_date=None, statuses=None):
+    _migrate_legacy_history()
+    return _iter_segments(start_date, end_date, statuses)
+
+
+def _iter_segments(start_date=None, end_date=None, statuses=None):
+    start = str(start_date) if start_date else None
+    end = str(end_date) if end_date else None
+
+    def in_range(record):
+        day = str(record.get("timestamp", ""))[:10]
+        if (start and day < start) or (end and day > end):
+            return False
+        return statuses is None or record.get("status") in statuses
+
+    for month in list_archive_months():
+        if (start and month < start[:7]) or (end and month > end[:7]):
+            continue
+        for record in iter_archive(month):
+            if in_range(record):
+                yield record
+    if os.path.exists(HISTORY_FILE):
+        with open(HISTORY_FILE, "r") as f:
+            for record in _iter_jsonl(f):
+                if in_range(record):
+                    yield record
+
+
+# Function to stream the records of one archived month
+def iter_archive(month):
+    try:
+        with gzip.open(_archive_path(month), "rt") as f:
+            yield from _iter_jsonl(f)
+    except (OSError, EOFError):
+        return
+
+
+# Function to identify the current contents of an archived month, so that
+# cached copies can tell when late records were appended or it was rewritten
+def archive_version(month):
+    try:
+        stat = os.stat(_archive_path(month))
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+# Function to open the active file for reading in binary mode, or return
+# None if there is none yet. For readers that keep their own position in it.
+def open_active_history():
+    _migrate_legacy_history()
+    try:
+        return open(HISTORY_FILE, "rb")
+    except FileNotFoundError:
+        return None
+
+
+# Function to load email history
+def load_history(start_date=None, end_date=None, statuses=None):
+    return list(iter_history(start_date, end_date, statuses))
+
+
+def make_history_record(sender, recipients, subject, status, error=None, message_id=None):
+    return {
+        "timestamp": datetime.now().strftime(TIMESTAMP_FORMAT),
+        "sender": sender,
+        "recipients": recipients,
+        "subject": subject,
+        "status": status,
+        "error": error,
+        "message_id": message_id
+    }
+
+
+# Append a batch of records with a single write while holding the history
+# lock, rotating the active file first if a new month has started
+def append_history_records(records):
+    if not records:
+        return
+    data = "".join(json.dumps(record) + "\n" for record in records)
+    with _history_lock():
+        if os.path.exists(LEGACY_HISTORY_FILE):
+            _migrate_legacy_history_locked()
+        now = datetime.now()
+        active_month = _active_month()
+        if active_month and active_month < now.strftime("%Y-%m"):
+            _rotate_history_locked(now)
+        with open(HISTORY_FILE, "a") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        _index_new_records(records)
+
+
+# Add appended records to the search index. The records are already on disk,
+# so an index that cannot be updated is dropped rather than failing the
+# append; a missing index is built from the full history on the next search.
+def _index_new_records(records):
+    if not history_index.index_exists():
+        return
+    try:
+        history_index.index_records(records)
+    except Exception:
+        logger.exception("Failed to index %d history records; the index will be rebuilt", len(records))
+        history_index.drop_index()
+
+
+# Function to save email history (synchronously, for one-off scripts)
+def save_to_history(sender, recipients, subject, status, error=None, message_id=None):
+    append_history_records([make_history_record(sender, recipients, subject, status, error, message_id)])
+
+
+# Rewrite one segment with update(record) applied to the records whose
+# Message-ID is in updates. Only lines carrying a wanted Message-ID are
+# decoded; everything else is written back as it was, and the file is only
+# replaced if something changed. Returns every record (changed or not) of
+# each Message-ID that had a change, by Message-ID.
+def _update_segment(path, opener, updates):
+    with opener(path, "rt") as f:
+        lines = f.readlines()
+    # Compared in their encoded form, so non-matching lines are never decoded
+    wanted = {json.dumps(message_id) for message_id in updates}
+    matched = set()
+    records = {}
+    for i, line in enumerate(lines):
+        match = _MESSAGE_ID_FIELD.search(line)
+        if match is None or match.group(1) not in wanted:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if updates[record["message_id"]](record):
+            lines[i] = json.dumps(record) + "\n"
+            matched.add(record["message_id"])
+        records.setdefault(record["message_id"], []).append(record)
+    if matched:
+        tmp_path = path + ".tmp"
+        with opener(tmp_path, "wt") as f:
+            f.writelines(lines)
+        os.replace(tmp_path, path)
+    return {message_id: records[message_id] for message_id in matched}
+
+
+# Function to change existing records by Message-ID. updates maps a
+# Message-ID to a function that modifies a record in place and returns True
+# if it changed it. Segments are searched newest first and a segment is only
+# rewritten when it holds a match. Returns the Message-IDs that were found.
+def update_history_records(updates):
+    if not updates:
+        return set()
+    remaining = dict(updates)
+    changed = {}
+    with _history_lock():
+        if os.path.exists(LEGACY_HISTORY_FILE):
+            _migrate_legacy_history_locked()
+        segments = [(HISTORY_FILE, open)] if os.path.exists(HISTORY_FILE) else []
+        segments += [(_archive_path(month), gzip.open) for month in reversed(list_archive_months())]
+        for path, opener in segments:
+            if not remaining:
+                break
+            try:
+                matched = _update_segment(path, opener, remaining)
+            except (OSError, EOFError):
+                continue
+            for message_id in matched:
+                del remaining[message_id]
+            changed.update(matched)
+        _reindex_records(changed)
+    return set(changed)
+
+
+# Update the search index rows of changed records in place. An index that
+# cannot be updated is dropped and rebuilt on the next search.
+def _reindex_records(records_by_message_id):
+    if not records_by_message_id or not history_index.index_exists():
+        return
+    try:
+        updated = history_index.update_records(records_by_message_id)
+    except Exception:
+        logger.exception("Failed to update the search index; it will be rebuilt")
+        updated = False
+    if not updated:
+        history_index.drop_index()
+
+
+# Background writer that group-commits history records. Sessions hand their
+# records to a queue and return immediately; a single thread collects
+# everything that arrives within flush_interval and appends it in one write.
+class HistoryWriter:
+    _STOP = object()
+
+    def __init__(self, flush_interval=0.2, max_batch=1000, max_retries=5):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # Same signature as the module level save_to_history
+    def save_to_history(self, sender, recipients, subject, status, error=None, message_id=None):
+        self._queue.put(make_history_record(sender, recipients, subject, status, error, message_id))
+
+    # Block until every record submitted so far has been committed
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                self._queue.task_done()
+                return
+            batch = [item]
+            taken = 1
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                taken += 1
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+            for _ in range(taken):
+                self._queue.task_done()
+
+    def _commit(self, batch):
+        for attempt in range(self.max_retries):
+            try:
+                append_history_records(batch)
+                return
+            except Exception:
+                logger.exception("Failed to write %d history records (attempt %d)", len(batch), attempt + 1)
+                time.sleep(self.flush_interval * (attempt + 1))
+        logger.error("Dropping %d history records after %d attempts", len(batch), self.max_retries)
+
+
+# Build the search index from the full history if it does not exist yet
+def _ensure_index():
+    if history_index.index_exists():
+        return
+    with _history_lock():
+        if os.path.exists(LEGACY_HISTORY_FILE):
+            _migrate_legacy_history_locked()
+        if not history_index.index_exists():
+            history_index.build_index(_iter_segments())
+
+
+# Function to search subjects, recipients, senders and errors
+def search_history(text, start_date=None, end_date=None, statuses=None, limit=500):
+    _ensure_index()
+    return history_index.search(text, start_date, end_date, statuses, limit)
+
+
+# Streaming variant of search_history without a result limit
+def iter_search_history(text, start_date=None, end_date=None, statuses=None):
+    _ensure_index()
+    return history_index.iter_search(text, start_date, end_date, statuses)
+
+
+# Earliest date covered by history on disk, used as the date filter's lower bound
+def history_start_date():
+    _migrate_legacy_history()
+    months = list_archive_months()
+    if months:
+        return datetime.strptime(months[0] + "-01", "%Y-%m-%d").date()
+    active_month = _active_month()
+    if active_month:
+        return datetime.strptime(active_month + "-01", "%Y-%m-%d").date()
+    return None
+
+
+# Remove the active file and every archived segment
+def clear_history():
+    with _history_lock():
+        for path in (HISTORY_FILE, LEGACY_HISTORY_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+        for month in list_archive_months():
+            os.remove(_archive_path(month))
+        history_index.drop_index()
@@ -0,0 +1,119 @@
+import csv
+import io
+import json
+
+# Streaming export of history records. Records are pulled from a generator
+# in chunks and each chunk is encoded and yielded as bytes straight away, so
+# memory use depends on the chunk size rather than on the size of the history.
+EXPORT_FIELDS = ["timestamp", "sender", "recipients", "subject", "status", "error", "message_id"]
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "JSONL": ("jsonl", "application/x-ndjson"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+DEFAULT_CHUNK_SIZE = 10000
+
+
+# Group an iterable of records into lists of at most chunk_size records
+def _chunks(records, chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _export_csv(records, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for chunk in _chunks(records, chunk_size):
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _export_jsonl(records, chunk_size):
+    for chunk in _chunks(records, chunk_size):
+        lines = [
+            json.dumps({field: record.get(field) for field in EXPORT_FIELDS})
+            for record in chunk
+        ]
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+# Write-only file object handed to pyarrow; bytes written since the last
+# drain() are handed back to the caller instead of being kept around
+class _ChunkSink(io.RawIOBase):
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def _export_parquet(records, chunk_size):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export requires pyarrow (pip install pyarrow)")
+
+    schema = pa.schema([(field, pa.string()) for field in EXPORT_FIELDS])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        # Every chunk becomes its own row group
+        for chunk in _chunks(records, chunk_size):
+            columns = {
+                field: [None if record.get(field) is None else str(record.get(field)) for record in chunk]
+                for field in EXPORT_FIELDS
+            }
+            writer.write_table(pa.table(columns, schema=schema))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+# Function to export records as a stream of byte chunks in the given format
+def export_history(records, fmt, chunk_size=DEFAULT_CHUNK_SIZE):
+    if fmt == "CSV":
+        return _export_csv(records, chunk_size)
+    if fmt == "JSONL":
+        return _export_jsonl(records, chunk_size)
+    if fmt == "Parquet":
+        return _export_parquet(records, chunk_size)
+    raise ValueError(f"Unsupported export format: {fmt}")
+
+
+# Function to stream an export into an open binary file
+def write_export(records, fmt, f, chunk_size=DEFAULT_CHUNK_SIZE):
+    written = 0
+    for data in export_history(records, fmt, chunk_size):
+        f.write(data)
+        written += len(data)
+    return written
@@ -0,0 +1,321 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+import metrics
+from history import TIMESTAMP_FORMAT, archive_version, iter_archive, list_archive_months, open_active_history
+
+# Compact columnar form of the email history for the History page. Records
+# are converted in chunks straight into typed columns, so the list of dicts
+# never exists in full: status and sender are categoricals (a handful of
+# distinct values each), the timestamp is parsed once into datetime64 with
+# the day precomputed next to it, and only the free-text fields stay strings.
+FRAME_COLUMNS = ["timestamp", "date", "sender", "recipients", "subject", "status", "error", "message_id"]
+CATEGORY_COLUMNS = ["sender", "status"]
+TEXT_COLUMNS = ["recipients", "subject", "error", "message_id"]
+DEFAULT_CHUNK_SIZE = 100000
+PAGE_SIZE = 50
+
+# Bytes just before the cached offset that must be unchanged for the active
+# file to count as the same file that was read before
+_CHECK_BYTES = 64
+
+STATUS_BADGES = {
+    "SUCCESS": "<span class='status-badge status-success'>Success</span>",
+    "FAILED": "<span class='status-badge status-failed'>Failed</span>",
+    "BOUNCED": "<span class='status-badge status-failed'>Bounced</span>",
+    "SUPPRESSED": "<span class='status-badge' style='background-color:#fff3cd;color:#856404'>Suppressed</span>",
+    "TEST": "<span class='status-badge' style='background-color:#e2e3e5;color:#383d41'>Test</span>",
+}
+
+
+# Function to get the HTML badge for a status; only called for displayed rows
+def status_badge(status):
+    return STATUS_BADGES.get(status, status)
+
+
+def format_timestamp(timestamp):
+    return "" if pd.isna(timestamp) else timestamp.strftime(TIMESTAMP_FORMAT)
+
+
+def _chunk_frame(chunk):
+    timestamps = pd.to_datetime(pd.Series([record.get("timestamp") for record in chunk], dtype=object),
+                                format=TIMESTAMP_FORMAT, errors="coerce")
+    data = {"timestamp": timestamps, "date": timestamps.dt.normalize()}
+    for column in CATEGORY_COLUMNS:
+        data[column] = pd.Categorical([record.get(column) for record in chunk])
+    for column in TEXT_COLUMNS:
+        data[column] = pd.Series([record.get(column) for record in chunk], dtype=object)
+    return pd.DataFrame(data, columns=FRAME_COLUMNS)
+
+
+def empty_history_frame():
+    return _chunk_frame([])
+
+
+# Function to join history frames end to end. Categoricals built from
+# different chunks have different categories, which a plain concat would
+# turn back into object columns, so their categories are merged instead.
+def concat_history_frames(frames):
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return empty_history_frame()
+    if len(frames) == 1:
+        return frames[0]
+    data = {}
+    for column in FRAME_COLUMNS:
+        if column in CATEGORY_COLUMNS:
+            data[column] = union_categoricals([frame[column] for frame in frames])
+        else:
+            data[column] = pd.concat([frame[column] for frame in frames], ignore_index=True)
+    return pd.DataFrame(data, columns=FRAME_COLUMNS)
+
+
+# Function to build the compact frame from an iterable of history records
+# (e.g. iter_history()), converting chunk_size records at a time
+def build_history_frame(records, chunk_size=DEFAULT_CHUNK_SIZE):
+    return concat_history_frames([_chunk_frame(chunk) for chunk in _chunks(records, chunk_size)])
+
+
+def _chunks(records, chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Function to keep the rows with one of the given statuses. The frame itself
+# is returned when no row can be dropped, which saves copying it.
+def select_statuses(frame, statuses):
+    if set(frame["status"].cat.categories) <= set(statuses):
+        return frame
+    return frame[frame["status"].isin(statuses)]
+
+
+def page_count(frame, page_size=PAGE_SIZE):
+    return max(1, -(-len(frame) // page_size))
+
+
+# Function to get the rows of one page (numbered from 1) of a frame
+def history_page(frame, page, page_size=PAGE_SIZE):
+    start = (page - 1) * page_size
+    return frame.iloc[start:start + page_size]
+
+
+# Growable columns behind the cached history. Rows are appended in place
+# into arrays with spare capacity and frame() wraps the filled part without
+# copying, so adding a few records costs the same however long the history
+# is. Rows are never changed once written, so frames handed out earlier stay
+# valid while more rows are appended.
+class _FrameBuffer:
+    def __init__(self):
+        self._size = 0
+        self._arrays = {}
+        self._codes = {column: {} for column in CATEGORY_COLUMNS}
+        self._frame = None
+
+    def __len__(self):
+        return self._size
+
+    # Move the filled part into new arrays with room for at least capacity rows
+    def _resize(self, capacity):
+        arrays = {}
+        for column in FRAME_COLUMNS:
+            if column in CATEGORY_COLUMNS:
+                array = np.empty(capacity, dtype=np.int32)
+            elif column in TEXT_COLUMNS:
+                array = np.empty(capacity, dtype=object)
+            else:
+                array = np.empty(capacity, dtype="datetime64[ns]")
+            if self._arrays:
+                array[:self._size] = self._arrays[column][:self._size]
+            arrays[column] = array
+        self._arrays = arrays
+
+    def append(self, frame):
+        rows = len(frame)
+        if not rows:
+            return
+        capacity = len(self._arrays["timestamp"]) if self._arrays else 0
+        if self._size + rows > capacity:
+            self._resize(max(self._size + rows, capacity * 2, 1024))
+        end = self._size + rows
+        for column in FRAME_COLUMNS:
+            values = frame[column]
+            if column in CATEGORY_COLUMNS:
+                codes = self._codes[column]
+                # The extra last entry maps missing values (code -1) to -1 again
+                mapping = np.array([codes.setdefault(value, len(codes)) for value in values.cat.categories] + [-1],
+                                   dtype=np.int32)
+                self._arrays[column][self._size:end] = mapping[values.cat.codes.to_numpy()]
+            else:
+                self._arrays[column][self._size:end] = values.to_numpy()
+        self._size = end
+        self._frame = None
+
+    def frame(self):
+        if not self._size:
+            return empty_history_frame()
+        if self._frame is None:
+            data = {}
+            for column in FRAME_COLUMNS:
+                values = self._arrays[column][:self._size]
+                if column in CATEGORY_COLUMNS:
+                    values = pd.Categorical.from_codes(values, list(self._codes[column]), validate=False)
+                data[column] = values
+            self._frame = pd.DataFrame(data, columns=FRAME_COLUMNS, copy=False)
+        return self._frame
+
+
+# (first day, last day) covered by a frame, or (None, None) if it is empty
+def _date_span(frame):
+    first, last = frame["date"].min(), frame["date"].max()
+    if pd.isna(first):
+        return None, None
+    return first, last
+
+
+# Per-process cache of the history for the History page. Archived months
+# are cached one frame per month, loaded the first time a requested range
+# overlaps them and loaded again only when their archive_version changes.
+# The active file is read incrementally into a _FrameBuffer; on every call
+# only the bytes appended since the cached offset are parsed and added. If
+# it was replaced (rotation, bounce updates), truncated or cleared, it is
+# read again from the start.
+class HistoryFrameCache:
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._months = {}
+        self._active = _FrameBuffer()
+        self._generation = 0
+        self._active_dates = (None, None)
+        self._identity = None
+        self._offset = 0
+        self._check = b""
+        self._joined = (None, None)
+
+    # Append a chunk of records to the active rows and widen their date span
+    def _append(self, chunk):
+        frame = _chunk_frame(chunk)
+        self._active.append(frame)
+        first, last = _date_span(frame)
+        if first is None:
+            return
+        if self._active_dates[0] is None:
+            self._active_dates = (first, last)
+        else:
+            self._active_dates = (min(self._active_dates[0], first), max(self._active_dates[1], last))
+
+    # Cached (version, frame, date span) of an archived month
+    def _month(self, month):
+        version = archive_version(month)
+        cached = self._months.get(month)
+        if cached is None or cached[0] != version:
+            frame = build_history_frame(iter_archive(month), self.chunk_size)
+            cached = self._months[month] = (version, frame, _date_span(frame))
+            metrics.increment("history.cache_month_loads")
+        return cached
+
+    # The active file is the one read before if it has the same identity,
+    # has not shrunk, and still holds the same bytes just before the offset
+    def _continues(self, f, identity, size):
+        if identity != self._identity or size < self._offset:
+            return False
+        if f is None:
+            return True
+        f.seek(self._offset - len(self._check))
+        return f.read(len(self._check)) == self._check
+
+    # Yield the records of the complete lines from the current offset,
+    # advancing it past every line consumed. A last line without its newline
+    # is still being written and is left for the next call.
+    def _read_lines(self, f, size):
+        f.seek(self._offset)
+        for line in f:
+            if not line.endswith(b"\n") or self._offset + len(line) > size:
+                break
+            self._offset += len(line)
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+    def _refresh_active(self):
+        f = open_active_history()
+        try:
+            if f is None:
+                identity, size = None, 0
+            else:
+                stat = os.fstat(f.fileno())
+                identity, size = (stat.st_dev, stat.st_ino), stat.st_size
+            if not self._continues(f, identity, size):
+                # A new buffer, since frames handed out earlier still use the old one
+                self._active = _FrameBuffer()
+                self._generation += 1
+                self._active_dates = (None, None)
+                self._identity, self._offset, self._check = identity, 0, b""
+                metrics.increment("history.cache_reloads")
+            if size <= self._offset:
+                return
+            try:
+                for chunk in _chunks(self._read_lines(f, size), self.chunk_size):
+                    self._append(chunk)
+            except Exception:
+                # The offset may have moved past records that were not kept
+                self._identity = None
+                raise
+            metrics.increment("history.cache_tail_reads")
+            start = max(0, self._offset - _CHECK_BYTES)
+            f.seek(start)
+            self._check = f.read(self._offset - start)
+        finally:
+            if f is not None:
+                f.close()
+
+    # Function to get the history between two dates (datetime.date or
+    # "YYYY-MM-DD" strings, both inclusive) as a compact frame
+    def frame(self, start_date=None, end_date=None):
+        start = str(start_date) if start_date else None
+        end = str(end_date) if end_date else None
+        with self._lock:
+            archived = list_archive_months()
+            # Months that were cleared are forgotten
+            for month in set(self._months) - set(archived):
+                del self._months[month]
+            months = [month for month in archived
+                      if not ((start and month < start[:7]) or (end and month > end[:7]))]
+            parts = [self._month(month) for month in months]
+            self._refresh_active()
+            # Joining copies the rows, so the joined frame is kept until a
+            # month or the active rows change
+            key = (tuple((month, part[0]) for month, part in zip(months, parts)), self._generation, len(self._active))
+            if self._joined[0] == key:
+                frame = self._joined[1]
+            else:
+                frame = concat_history_frames([part[1] for part in parts] + [self._active.frame()])
+                self._joined = (key, frame) if parts else (None, None)
+            spans = [part[2] for part in parts] + [self._active_dates]
+        # The usual range covers every day in the rows, which needs no mask
+        days = [day for span in spans for day in span if day is not None]
+        start = pd.Timestamp(start) if start else None
+        end = pd.Timestamp(end) if end else None
+        if not days or ((start is None or start <= min(days)) and (end is None or max(days) <= end)):
+            return frame
+        keep = pd.Series(True, index=frame.index)
+        if start is not None:
+            keep &= frame["date"] >= start
+        if end is not None:
+            keep &= frame["date"] <= end
+        return frame[keep]
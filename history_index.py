@@ -0,0 +1,223 @@
+import os
+import sqlite3
+
+# Full-text index over the email history, kept in SQLite next to the history
+# segments. Records are added as they are saved, so searching never has to
+# scan the segments themselves. Every record is a row of an ordinary table
+# with an FTS5 table over its text columns that shares the table's rowids.
+# The first and last rowid of every day are kept in a table of their own, so
+# a date range becomes a rowid range the full-text match is limited to, and
+# the day and status of each match are checked in its row.
+INDEX_FILE = "email_history_index.db"
+# Stored once a build has committed; an index without it is rebuilt
+SCHEMA_VERSION = "3"
+
+
+def _connect():
+    conn = sqlite3.connect(INDEX_FILE, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS history ("
+        "id INTEGER PRIMARY KEY, day TEXT NOT NULL, status TEXT NOT NULL, timestamp TEXT, "
+        "sender TEXT, recipients TEXT, subject TEXT, error TEXT, message_id TEXT)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS history_message_id ON history (message_id)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS days (day TEXT PRIMARY KEY, first_id INTEGER, last_id INTEGER) WITHOUT ROWID"
+    )
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5("
+        "subject, recipients, sender, error, content='history', content_rowid='id')"
+    )
+    return conn
+
+
+# Function to tell whether a complete index of the current layout exists
+def index_exists():
+    if not os.path.exists(INDEX_FILE):
+        return False
+    try:
+        conn = sqlite3.connect(INDEX_FILE, timeout=30)
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+    return row is not None and row[0] == SCHEMA_VERSION
+
+
+def _insert(conn, records):
+    spans = {}
+    for record in records:
+        timestamp = record.get("timestamp") or ""
+        values = (
+            timestamp[:10], record.get("status") or "", timestamp,
+            record.get("sender") or "", record.get("recipients") or "",
+            record.get("subject") or "", record.get("error") or "", record.get("message_id"),
+        )
+        rowid = conn.execute(
+            "INSERT INTO history (day, status, timestamp, sender, recipients, subject, error, message_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            values
+        ).lastrowid
+        conn.execute(
+            "INSERT INTO history_fts (rowid, subject, recipients, sender, error) VALUES (?, ?, ?, ?, ?)",
+            (rowid, values[5], values[4], values[3], values[6])
+        )
+        span = spans.get(values[0])
+        if span is None:
+            spans[values[0]] = [rowid, rowid]
+        else:
+            span[1] = rowid
+    conn.executemany(
+        "INSERT INTO days (day, first_id, last_id) VALUES (?, ?, ?) "
+        "ON CONFLICT(day) DO UPDATE SET first_id = min(first_id, excluded.first_id), "
+        "last_id = max(last_id, excluded.last_id)",
+        [(day, first, last) for day, (first, last) in spans.items()]
+    )
+
+
+# Function to build the index from the full history. The build commits in
+# one transaction together with the schema row, so an interrupted build
+# leaves an index that is not taken for complete.
+def build_index(records):
+    drop_index()
+    conn = _connect()
+    try:
+        with conn:
+            _insert(conn, records)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema', ?)", (SCHEMA_VERSION,))
+    finally:
+        conn.close()
+
+
+# Add history records to the index
+def index_records(records):
+    conn = _connect()
+    try:
+        with conn:
+            _insert(conn, records)
+    finally:
+        conn.close()
+
+
+# Function to apply changes made to existing records (bounces) to their rows.
+# records_by_message_id maps a Message-ID to all its records, in history
+# order, which pair up with its rows in rowid order. The day and timestamp
+# of a record never change. Returns False if the rows do not pair up, in
+# which case the index has to be rebuilt.
+def update_records(records_by_message_id):
+    conn = _connect()
+    try:
+        with conn:
+            for message_id, records in records_by_message_id.items():
+                rows = conn.execute(
+                    "SELECT id, subject, recipients, sender, error FROM history WHERE message_id = ? ORDER BY id",
+                    (message_id,)
+                ).fetchall()
+                if len(rows) != len(records):
+                    conn.rollback()
+                    return False
+                for (rowid, *old), record in zip(rows, records):
+                    new = (record.get("subject") or "", record.get("recipients") or "",
+                           record.get("sender") or "", record.get("error") or "")
+                    conn.execute(
+                        "INSERT INTO history_fts (history_fts, rowid, subject, recipients, sender, error) "
+                        "VALUES ('delete', ?, ?, ?, ?, ?)",
+                        (rowid, *old)
+                    )
+                    conn.execute(
+                        "UPDATE history SET status = ?, subject = ?, recipients = ?, sender = ?, error = ? "
+                        "WHERE id = ?",
+                        (record.get("status") or "", *new, rowid)
+                    )
+                    conn.execute(
+                        "INSERT INTO history_fts (rowid, subject, recipients, sender, error) VALUES (?, ?, ?, ?, ?)",
+                        (rowid, *new)
+                    )
+        return True
+    finally:
+        conn.close()
+
+
+# Turn free text into an FTS5 query: every word must match, and the last
+# word also matches as a prefix so results update while typing
+def _build_query(text):
+    terms = [term.replace('"', '""') for term in text.split()]
+    if not terms:
+        return None
+    phrases = [f'"{term}"' for term in terms]
+    phrases[-1] += "*"
+    return " AND ".join(phrases)
+
+
+# Stream matching records newest first, fetching rows from SQLite in batches
+def iter_search(text, start_date=None, end_date=None, statuses=None, limit=None, batch_size=1000):
+    query = _build_query(text)
+    if query is None or (statuses is not None and not statuses):
+        return
+
+    conn = _connect()
+    try:
+        day_filter = ""
+        day_params = []
+        if start_date:
+            day_filter += " AND day >= ?"
+            day_params.append(str(start_date))
+        if end_date:
+            day_filter += " AND day <= ?"
+            day_params.append(str(end_date))
+
+        sql = (
+            "SELECT h.timestamp, h.sender, h.recipients, h.subject, h.status, h.error, h.message_id "
+            "FROM history_fts f CROSS JOIN history h ON h.id = f.rowid "
+            "WHERE history_fts MATCH ?"
+        )
+        params = [query]
+        if day_params:
+            # The rowids of the date range bound the full-text match
+            first, last = conn.execute(
+                "SELECT min(first_id), max(last_id) FROM days WHERE 1" + day_filter, day_params
+            ).fetchone()
+            if first is None:
+                return
+            sql += " AND f.rowid BETWEEN ? AND ?" + day_filter.replace("day", "h.day")
+            params += [first, last] + day_params
+        if statuses is not None:
+            sql += f" AND h.status IN ({', '.join('?' * len(statuses))})"
+            params.extend(statuses)
+        sql += " ORDER BY f.rowid DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for timestamp, sender, recipients, subject, status, error, message_id in rows:
+                yield {
+                    "timestamp": timestamp,
+                    "sender": sender,
+                    "recipients": recipients,
+                    "subject": subject,
+                    "status": status,
+                    "error": error or None,
+                    "message_id": message_id
+                }
+    finally:
+        conn.close()
+
+
+# Function to search the history index; returns records newest first
+def search(text, start_date=None, end_date=None, statuses=None, limit=500):
+    return list(iter_search(text, start_date, end_date, statuses, limit))
+
+
+def drop_index():
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(INDEX_FILE + suffix):
+            os.remove(INDEX_FILE + suffix)
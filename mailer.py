@@ -0,0 +1,260 @@
+import hashlib
+import smtplib
+import ssl
+import threading
+import time
+
+import metrics
+
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 587
+
+# Idle connections older than this are checked with NOOP before reuse, and
+# dropped after MAX_IDLE_SECONDS since most relays close idle sessions anyway
+NOOP_AFTER_SECONDS = 10
+MAX_IDLE_SECONDS = 120
+
+# Reply code classes (RFC 5321): 5xx will fail again, 4xx may succeed later
+PERMANENT = "permanent"
+TRANSIENT = "transient"
+
+
+# Function to classify an SMTP reply code; no code (e.g. a dropped
+# connection) counts as transient
+def classify_reply_code(code):
+    if code is not None and 500 <= code < 600:
+        return PERMANENT
+    return TRANSIENT
+
+
+def reply_text(reply):
+    if isinstance(reply, bytes):
+        reply = reply.decode("utf-8", "replace")
+    return " ".join(str(reply).split())
+
+
+# Function to tell whether retrying a failed send is pointless: every
+# recipient was refused permanently, or the relay gave a 5xx reply
+def is_permanent_error(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(classify_reply_code(code) == PERMANENT for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return classify_reply_code(error.smtp_code) == PERMANENT
+    return False
+
+
+# Function to turn a send exception into the error text saved in history,
+# e.g. "Permanent failure 550: 5.1.1 No such user"
+def describe_smtp_error(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        refusals = [
+            f"{address} ({classify_reply_code(code)} {code}: {reply_text(reply)})"
+            for address, (code, reply) in error.recipients.items()
+        ]
+        return "Recipients refused: " + "; ".join(refusals)
+    if isinstance(error, smtplib.SMTPResponseException):
+        kind = classify_reply_code(error.smtp_code).capitalize()
+        return f"{kind} failure {error.smtp_code}: {reply_text(error.smtp_error)}"
+    if isinstance(error, (smtplib.SMTPException, OSError)):
+        return f"Transient failure: {error}"
+    return str(error)
+
+
+# smtplib.SMTP whose STARTTLS can resume an earlier TLS session, so that
+# reconnects to the same relay get an abbreviated handshake
+class ResumableSMTP(smtplib.SMTP):
+    def starttls(self, context=None, session=None):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn("starttls"):
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        resp, reply = self.docmd("STARTTLS")
+        if resp != 220:
+            raise smtplib.SMTPResponseException(resp, reply)
+        if context is None:
+            context = ssl.create_default_context()
+        self.sock = context.wrap_socket(self.sock, server_hostname=self._host, session=session)
+        self.file = None
+        # RFC 3207: forget everything learned before the TLS negotiation
+        self.helo_resp = None
+        self.ehlo_resp = None
+        self.esmtp_features = {}
+        self.does_esmtp = False
+        return resp, reply
+
+    @property
+    def tls_session(self):
+        return getattr(self.sock, "session", None)
+
+    @property
+    def session_reused(self):
+        return bool(getattr(self.sock, "session_reused", False))
+
+
+class _PooledConnection:
+    def __init__(self, key, server):
+        self.key = key
+        self.server = server
+        self.last_used = time.monotonic()
+
+
+# Pool of authenticated SMTP sessions keyed by relay and account. It also
+# remembers the last TLS session per relay for resumption, and can open a
+# session in the background ahead of the first send.
+class SMTPConnectionPool:
+    def __init__(self, max_idle_per_key=2, timeout=30, context=None):
+        self.max_idle_per_key = max_idle_per_key
+        self.timeout = timeout
+        # Session resumption only works with the context that created the session
+        self.context = context or ssl.create_default_context()
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._tls_sessions = {}
+        self._prewarming = {}
+
+    @staticmethod
+    def _key(host, port, user, password, starttls):
+        digest = hashlib.sha256((password or "").encode()).hexdigest()
+        return host, port, user, digest, starttls
+
+    # Open, secure and authenticate a new session. STARTTLS is required, so a
+    # relay (or anything in between) that does not offer it gets an
+    # SMTPNotSupportedError instead of the password; only starttls=False,
+    # for relays configured without TLS, logs in on a plain session.
+    def _connect(self, key, host, port, user, password, starttls=True):
+        start = time.perf_counter()
+        server = ResumableSMTP(host, port, timeout=self.timeout)
+        try:
+            server.ehlo()
+            if starttls:
+                server.starttls(self.context, session=self._tls_sessions.get((host, port)))
+                server.ehlo()
+                metrics.increment("smtp.tls_resumed" if server.session_reused else "smtp.tls_full_handshake")
+            if user and password:
+                server.login(user, password)
+        except Exception:
+            server.close()
+            raise
+        self._remember_tls_session(host, port, server)
+        metrics.observe("smtp.connect", time.perf_counter() - start)
+        metrics.increment("smtp.connections_opened")
+        return _PooledConnection(key, server)
+
+    def _remember_tls_session(self, host, port, server):
+        session = server.tls_session
+        if session is not None:
+            with self._lock:
+                self._tls_sessions[(host, port)] = session
+
+    # Check out a live session, reusing an idle one when possible
+    def acquire(self, host, port, user, password, starttls=True):
+        key = self._key(host, port, user, password, starttls)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                conn = idle.pop() if idle else None
+                warming = self._prewarming.get(key)
+            if conn is None and warming is not None:
+                # A background connect is already under way; waiting for it
+                # is never slower than starting a second handshake
+                warming.wait(self.timeout)
+                with self._lock:
+                    idle = self._idle.get(key)
+                    conn = idle.pop() if idle else None
+            if conn is None:
+                return self._connect(key, host, port, user, password, starttls)
+            idle_for = time.monotonic() - conn.last_used
+            if idle_for > MAX_IDLE_SECONDS:
+                self._close(conn)
+                continue
+            if idle_for > NOOP_AFTER_SECONDS:
+                try:
+                    if conn.server.noop()[0] != 250:
+                        raise smtplib.SMTPServerDisconnected("NOOP failed")
+                except (smtplib.SMTPException, OSError):
+                    self._close(conn)
+                    continue
+            metrics.increment("smtp.connections_reused")
+            return conn
+
+    # Return a session to the pool after a successful transaction
+    def release(self, conn):
+        conn.last_used = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(conn.key, [])
+            if len(idle) < self.max_idle_per_key:
+                idle.append(conn)
+                return
+        self._close(conn)
+
+    def discard(self, conn):
+        self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.server.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.server.close()
+
+    # Open an authenticated session in a background thread so that the next
+    # send finds it ready. Does nothing if one is already idle or being opened.
+    def prewarm(self, host, port, user, password, starttls=True):
+        if not user or not password:
+            return
+        key = self._key(host, port, user, password, starttls)
+        with self._lock:
+            if self._idle.get(key) or key in self._prewarming:
+                return
+            done = self._prewarming[key] = threading.Event()
+
+        def warm():
+            try:
+                conn = self._connect(key, host, port, user, password, starttls)
+                self.release(conn)
+                metrics.increment("smtp.prewarmed")
+            except Exception:
+                metrics.increment("smtp.prewarm_failed")
+            finally:
+                with self._lock:
+                    self._prewarming.pop(key, None)
+                done.set()
+
+        threading.Thread(target=warm, name="smtp-prewarm", daemon=True).start()
+
+    def close_all(self):
+        with self._lock:
+            conns = [conn for idle in self._idle.values() for conn in idle]
+            self._idle.clear()
+        for conn in conns:
+            self._close(conn)
+
+
+# Function to send a message through the pool. A pooled session that turns
+# out to be dead is replaced once; authentication and recipient errors are
+# raised to the caller unchanged. Returns the recipients the relay refused
+# while accepting the others, as {address: (code, reply)}.
+def send_message(pool, host, port, user, password, sender, recipients, msg, starttls=True):
+    start = time.perf_counter()
+    for attempt in range(2):
+        conn = pool.acquire(host, port, user, password, starttls)
+        try:
+            refused = conn.server.sendmail(sender, recipients, msg.as_string())
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            pool.discard(conn)
+            if attempt:
+                raise
+            continue
+        except smtplib.SMTPRecipientsRefused as e:
+            # The session itself is fine after a refused RCPT
+            pool.release(conn)
+            for code, _ in e.recipients.values():
+                metrics.increment(f"smtp.recipients_refused_{classify_reply_code(code)}")
+            raise
+        except Exception:
+            pool.discard(conn)
+            raise
+        pool.release(conn)
+        metrics.observe("smtp.submit_to_accepted", time.perf_counter() - start)
+        metrics.increment("smtp.messages_sent")
+        for code, _ in refused.values():
+            metrics.increment(f"smtp.recipients_refused_{classify_reply_code(code)}")
+        return refused
@@ -0,0 +1,49 @@
+import threading
+from collections import defaultdict, deque
+
+# In-process counters and latency samples, shown on the Settings page.
+# Only the most recent samples of each timing are kept.
+MAX_SAMPLES = 1000
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_timings = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+# Record a duration in seconds
+def observe(name, seconds):
+    with _lock:
+        _timings[name].append(seconds)
+
+
+def _percentile(samples, fraction):
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+
+# Copy of all counters plus count/avg/p50/p95/max (in milliseconds) per timing
+def snapshot():
+    with _lock:
+        counters = dict(_counters)
+        timings = {name: sorted(samples) for name, samples in _timings.items() if samples}
+    summary = {}
+    for name, samples in timings.items():
+        summary[name] = {
+            "count": len(samples),
+            "avg_ms": sum(samples) / len(samples) * 1000,
+            "p50_ms": _percentile(samples, 0.50) * 1000,
+            "p95_ms": _percentile(samples, 0.95) * 1000,
+            "max_ms": samples[-1] * 1000,
+        }
+    return {"counters": counters, "timings": summary}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timings.clear()
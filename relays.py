@@ -0,0 +1,283 @@
+import json
+import logging
+import os
+import random
+import smtplib
+import threading
+import time
+
+import metrics
+from mailer import SMTP_HOST, SMTP_PORT, TRANSIENT, classify_reply_code, send_message
+
+# Routing table of SMTP relays. Each relay has its own host, port and
+# optionally credentials, a weight and sending quotas. Relays are probed in
+# the background, each send goes to a relay picked at random in proportion
+# to its weight divided by its recent latency, and a send fails over to the
+# next relay on connection errors or throttling replies, so a slow or dead
+# relay does not hold up sending. Without a routing table every email goes
+# through SMTP_HOST:SMTP_PORT as before.
+#
+# relays.json:
+#     [
+#         {"name": "primary", "host": "smtp.example.com", "port": 587, "weight": 3,
+#          "username": "mailer@example.com", "password_env": "PRIMARY_SMTP_PASSWORD",
+#          "max_per_minute": 100, "max_per_day": 10000},
+#         {"name": "gmail", "host": "smtp.gmail.com", "port": 587}
+#     ]
+#
+# Relays without credentials log in with those of the sending account.
+# STARTTLS is required unless a relay sets "starttls": false, which is only
+# meant for local relays such as the stand-in server.
+# Quotas are counted per process.
+RELAYS_FILE = os.getenv("SMTP_RELAYS_FILE", "relays.json")
+PROBE_INTERVAL_SECONDS = 30
+PROBE_TIMEOUT_SECONDS = 5
+# A relay that failed is tried last for this long, doubling with every
+# consecutive failure
+COOLDOWN_SECONDS = 5
+MAX_COOLDOWN_SECONDS = 300
+# Weight of the newest sample in a relay's latency moving average
+LATENCY_SMOOTHING = 0.3
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(smtplib.SMTPException):
+    pass
+
+
+# Function to load the routing table, falling back to the single default relay
+def load_relays(path=RELAYS_FILE):
+    if not os.path.exists(path):
+        return [{"name": "default", "host": SMTP_HOST, "port": SMTP_PORT}]
+    with open(path, "r") as f:
+        table = json.load(f)
+    relays = []
+    for i, entry in enumerate(table):
+        if not entry.get("host"):
+            raise ValueError(f"Relay {i + 1} in {path} has no host")
+        relay = dict(entry)
+        relay.setdefault("name", f"{relay['host']}:{relay.get('port', SMTP_PORT)}")
+        if relay.get("password_env"):
+            relay["password"] = os.getenv(relay.pop("password_env"))
+        relays.append(relay)
+    if not relays:
+        raise ValueError(f"{path} lists no relays")
+    # Relays with weight 0 are never routed to
+    if not any(float(relay.get("weight", 1)) > 0 for relay in relays):
+        raise ValueError(f"{path} gives no relay a positive weight")
+    return relays
+
+
+# Function to tell whether another relay might succeed where this one failed:
+# the relay could not be reached, rejected our credentials or asked us to
+# slow down. Recipient refusals and permanent replies to the message fail
+# the same way everywhere and are raised instead.
+def fails_over(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return False
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPAuthenticationError,
+                          smtplib.SMTPNotSupportedError, QuotaExceeded)):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return classify_reply_code(error.smtp_code) == TRANSIENT
+    return isinstance(error, OSError)
+
+
+class _Relay:
+    def __init__(self, config):
+        self.name = config["name"]
+        self.host = config["host"]
+        self.port = int(config.get("port", SMTP_PORT))
+        self.username = config.get("username")
+        self.password = config.get("password")
+        self.starttls = config.get("starttls", True) is not False
+        self.weight = float(config.get("weight", 1))
+        self.max_per_minute = config.get("max_per_minute")
+        self.max_per_day = config.get("max_per_day")
+        self.latency = None
+        self.failures = 0
+        self.down_until = 0.0
+        self.last_error = None
+        self._minute = self._day = None
+        self.sent_this_minute = self.sent_today = 0
+
+    def credentials(self, user, password):
+        if self.username:
+            return self.username, self.password
+        return user, password
+
+    def observe_latency(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+
+    def mark_up(self):
+        self.failures = 0
+        self.down_until = 0.0
+        self.last_error = None
+
+    def mark_down(self, error):
+        self.failures += 1
+        self.down_until = time.monotonic() + min(COOLDOWN_SECONDS * 2 ** (self.failures - 1), MAX_COOLDOWN_SECONDS)
+        self.last_error = str(error)
+
+    # Count a send against the quotas; False if one of them is used up
+    def reserve(self):
+        now = time.time()
+        minute, day = int(now // 60), int(now // 86400)
+        if minute != self._minute:
+            self._minute, self.sent_this_minute = minute, 0
+        if day != self._day:
+            self._day, self.sent_today = day, 0
+        if (self.max_per_minute and self.sent_this_minute >= self.max_per_minute) or \
+                (self.max_per_day and self.sent_today >= self.max_per_day):
+            return False
+        self.sent_this_minute += 1
+        self.sent_today += 1
+        return True
+
+    def unreserve(self):
+        self.sent_this_minute = max(0, self.sent_this_minute - 1)
+        self.sent_today = max(0, self.sent_today - 1)
+
+
+class RelayRouter:
+    def __init__(self, relays, pool, probe_interval=PROBE_INTERVAL_SECONDS, probe_timeout=PROBE_TIMEOUT_SECONDS):
+        self.pool = pool
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self._relays = [_Relay(config) for config in relays]
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    # Start the background probes. With a single relay there is nothing to
+    # choose between, so it is not probed.
+    def start(self):
+        if self._thread is None and len(self._relays) > 1:
+            self._thread = threading.Thread(target=self._run_probes, name="smtp-relay-probes", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run_probes(self):
+        while not self._stopped.is_set():
+            self.probe_all()
+            self._stopped.wait(self.probe_interval)
+
+    # Connect, read the greeting and EHLO. A relay that answers is healthy
+    # again, one that does not (or greets with 421) is cooled down.
+    def probe(self, relay):
+        start = time.perf_counter()
+        try:
+            server = smtplib.SMTP(relay.host, relay.port, timeout=self.probe_timeout)
+            try:
+                code, reply = server.ehlo()
+                if code != 250:
+                    raise smtplib.SMTPHeloError(code, reply)
+            finally:
+                server.close()
+        except (smtplib.SMTPException, OSError) as e:
+            with self._lock:
+                relay.mark_down(e)
+            metrics.increment("relay.probe_failed")
+            return False
+        with self._lock:
+            relay.observe_latency(time.perf_counter() - start)
+            relay.mark_up()
+        return True
+
+    def probe_all(self):
+        for relay in self._relays:
+            if self._stopped.is_set():
+                return
+            self.probe(relay)
+
+    def _score(self, relay, default_latency):
+        return relay.weight / max(relay.latency if relay.latency is not None else default_latency, 0.001)
+
+    # Order in which to try the relays for one send: the healthy ones drawn
+    # at random by weight over latency, then the cooling-down ones, soonest
+    # back first
+    def _route(self):
+        now = time.monotonic()
+        with self._lock:
+            healthy = [relay for relay in self._relays if relay.down_until <= now and relay.weight > 0]
+            cooling = sorted((relay for relay in self._relays if relay.down_until > now and relay.weight > 0),
+                             key=lambda relay: relay.down_until)
+            known = [relay.latency for relay in healthy if relay.latency is not None]
+            # Relays not measured yet count as average, so they get traffic
+            default_latency = sum(known) / len(known) if known else 1.0
+            scores = [self._score(relay, default_latency) for relay in healthy]
+        order = []
+        while healthy:
+            index = random.choices(range(len(healthy)), scores)[0]
+            order.append(healthy.pop(index))
+            scores.pop(index)
+        return order + cooling
+
+    # Function to send a message through the best relay, failing over to the
+    # others. Returns the refused recipients like mailer.send_message.
+    def send_message(self, user, password, sender, recipients, msg):
+        last_error = None
+        for relay in self._route():
+            with self._lock:
+                reserved = relay.reserve()
+            if not reserved:
+                last_error = last_error or QuotaExceeded(f"Sending quota of relay {relay.name} is used up")
+                continue
+            relay_user, relay_password = relay.credentials(user, password)
+            start = time.perf_counter()
+            try:
+                refused = send_message(self.pool, relay.host, relay.port, relay_user, relay_password,
+                                       sender, recipients, msg, relay.starttls)
+            except Exception as e:
+                if not fails_over(e):
+                    raise
+                with self._lock:
+                    relay.unreserve()
+                    # Credentials from the user are rejected by every relay
+                    # that uses them, which says nothing about this relay
+                    if relay.username or not isinstance(e, smtplib.SMTPAuthenticationError):
+                        relay.mark_down(e)
+                logger.warning("Relay %s failed, trying the next one: %s", relay.name, e)
+                metrics.increment("relay.failovers")
+                last_error = e
+                continue
+            with self._lock:
+                relay.observe_latency(time.perf_counter() - start)
+                relay.mark_up()
+            metrics.increment(f"relay.{relay.name}.sent")
+            return refused
+        raise last_error or smtplib.SMTPException("No relay is available")
+
+    # Open a session in the background on the relay the next send most
+    # likely goes through
+    def prewarm(self, user, password):
+        order = self._route()
+        if order:
+            relay_user, relay_password = order[0].credentials(user, password)
+            self.pool.prewarm(order[0].host, order[0].port, relay_user, relay_password, order[0].starttls)
+
+    def status(self):
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "name": relay.name,
+                    "host": f"{relay.host}:{relay.port}",
+                    "healthy": relay.down_until <= now,
+                    "latency_ms": round(relay.latency * 1000, 1) if relay.latency is not None else None,
+                    "weight": relay.weight,
+                    "sent_this_minute": relay.sent_this_minute,
+                    "sent_today": relay.sent_today,
+                    "last_error": relay.last_error,
+                }
+                for relay in self._relays
+            ]
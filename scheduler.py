@@ -0,0 +1,375 @@
+import heapq
+import json
+import logging
+import os
+import smtplib
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from email import message_from_bytes
+from email.utils import make_msgid
+
+import metrics
+from mailer import describe_smtp_error, is_permanent_error
+from suppression import AllRecipientsSuppressed
+
+# Outbox of scheduled ("send at") and queued messages. Jobs are persisted in
+# SQLite so they survive restarts; in memory only (send_at, id) pairs are
+# kept in a min-heap, so a pending job costs a few dozen bytes and no work
+# until it is due. The scheduler thread sleeps until the earliest job is
+# due, then claims and delivers due jobs in batches.
+#
+# Any number of schedulers, in the app or in worker processes
+# ("python Main.py worker"), can share one outbox file. A job is claimed with
+# a lease that the claiming process keeps renewing while it sends; if the
+# process dies, the lease runs out and another process picks the job up.
+SCHEDULE_FILE = "scheduled_emails.db"
+LEASE_SECONDS = 60
+# Transient failures are retried with exponential backoff, a job that kept
+# its claimant from finishing this many times is given up on
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 30
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    # deliver(job, password) sends one job and raises on failure; it returns
+    # the recipients dropped as suppressed and the ones the relay refused
+    # (a dict like sendmail's), or None if every recipient was accepted.
+    # record_history has the signature of history.save_to_history. A
+    # scheduler given a sender advertises itself as a worker for that
+    # account, so the app can hand it messages to send.
+    def __init__(self, deliver, record_history=None, path=SCHEDULE_FILE,
+                 batch_size=100, poll_interval=30, lease_seconds=LEASE_SECONDS, sender=None):
+        self.deliver = deliver
+        self.record_history = record_history
+        self.path = path
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.sender = sender
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # Passwords entered in the form are only kept in memory; after a
+        # restart (or in another process) deliver() falls back to the
+        # configured account
+        self.credentials = {}
+        self._heap = []
+        self._known_max_id = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        # The heartbeat waits on its own event, so notifying the condition
+        # always wakes the run loop
+        self._heartbeat_stop = threading.Event()
+        self._thread = None
+        self._heartbeat_thread = None
+
+        # One connection for the scheduler's lifetime: opening and closing a
+        # connection per job costs a WAL checkpoint every time
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL this keeps commits durable across crashes of the app
+        # without an fsync per scheduled or delivered message
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._db_lock = threading.Lock()
+
+        with self._db() as conn:
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS scheduled ("
+                    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "send_at REAL NOT NULL, "
+                    "sender TEXT NOT NULL, "
+                    "recipients TEXT NOT NULL, "
+                    "history_recipients TEXT, "
+                    "subject TEXT, "
+                    "message BLOB NOT NULL, "
+                    "status TEXT NOT NULL DEFAULT 'pending', "
+                    "created_at REAL NOT NULL, "
+                    "claimed_at REAL, "
+                    "sent_at REAL, "
+                    "error TEXT)"
+                )
+                # Outboxes created before leases were introduced
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(scheduled)")}
+                for name, definition in (("lease_owner", "TEXT"), ("lease_expires", "REAL"),
+                                         ("attempts", "INTEGER NOT NULL DEFAULT 0")):
+                    if name not in columns:
+                        conn.execute(f"ALTER TABLE scheduled ADD COLUMN {name} {definition}")
+                conn.execute("CREATE INDEX IF NOT EXISTS scheduled_pending ON scheduled (status, send_at)")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS workers ("
+                    "id TEXT PRIMARY KEY, sender TEXT, started_at REAL NOT NULL, last_seen REAL NOT NULL)"
+                )
+        self._load_pending()
+
+    @contextmanager
+    def _db(self):
+        with self._db_lock:
+            yield self._conn
+
+    # Pull pending jobs we do not know about yet (new ones may have been
+    # added by another process, e.g. the CLI) into the heap
+    def _load_pending(self):
+        with self._db() as conn:
+            rows = conn.execute(
+                "SELECT send_at, id FROM scheduled WHERE status = 'pending' AND id > ?",
+                (self._known_max_id,)
+            ).fetchall()
+        if not rows:
+            return
+        with self._cond:
+            for send_at, job_id in rows:
+                heapq.heappush(self._heap, (send_at, job_id))
+                self._known_max_id = max(self._known_max_id, job_id)
+            self._cond.notify()
+
+    # Function to schedule a message; send_at is a datetime in local time.
+    # With deliver_here=False the job is left to other processes (outbox
+    # workers); this scheduler only takes it on a poll if it is still waiting.
+    def schedule(self, send_at, sender, recipients, subject, msg, history_recipients=None, password=None,
+                 deliver_here=True):
+        due = send_at.timestamp()
+        # Bounces are matched to the history by Message-ID
+        if msg['Message-ID'] is None:
+            msg['Message-ID'] = make_msgid()
+        message = msg.as_bytes()
+        with self._db() as conn, conn:
+            job_id = conn.execute(
+                "INSERT INTO scheduled (send_at, sender, recipients, history_recipients, subject, message, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (due, sender, json.dumps(list(recipients)), history_recipients or ", ".join(recipients),
+                 subject, message, time.time())
+            ).lastrowid
+        if password:
+            self.credentials[sender] = password
+        with self._cond:
+            if deliver_here:
+                heapq.heappush(self._heap, (due, job_id))
+                self._cond.notify()
+            self._known_max_id = max(self._known_max_id, job_id)
+        metrics.increment("scheduler.scheduled")
+        return job_id
+
+    # Function to list the next pending jobs (without the message bodies)
+    def pending(self, limit=20):
+        with self._db() as conn:
+            rows = conn.execute(
+                "SELECT id, send_at, sender, history_recipients, subject FROM scheduled "
+                "WHERE status = 'pending' ORDER BY send_at LIMIT ?",
+                (limit,)
+            ).fetchall()
+            total = conn.execute("SELECT COUNT(*) FROM scheduled WHERE status = 'pending'").fetchone()[0]
+        jobs = [
+            {"id": job_id, "send_at": send_at, "sender": sender, "recipients": recipients, "subject": subject}
+            for job_id, send_at, sender, recipients, subject in rows
+        ]
+        return total, jobs
+
+    # Function to count the worker processes currently delivering for a sender
+    def live_workers(self, sender):
+        with self._db() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM workers WHERE sender = ? AND last_seen > ? AND id != ?",
+                (sender, time.time() - self.lease_seconds, self.worker_id)
+            ).fetchone()[0]
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="email-scheduler", daemon=True)
+            self._thread.start()
+            self._heartbeat_thread = threading.Thread(target=self._heartbeat, name="email-scheduler-heartbeat",
+                                                      daemon=True)
+            self._heartbeat_thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._heartbeat_stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._heartbeat_thread.join()
+        with self._db() as conn:
+            with conn:
+                conn.execute("DELETE FROM workers WHERE id = ?", (self.worker_id,))
+            conn.close()
+
+    def join(self):
+        self._thread.join()
+
+    def _run(self):
+        next_poll = time.monotonic() + self.poll_interval
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    wait = next_poll - time.monotonic()
+                    if self._heap:
+                        wait = min(wait, self._heap[0][0] - now)
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                if self._stopped:
+                    return
+                # The heap only says when to look; which jobs are delivered
+                # is decided by the claim, since other processes share them
+                now = time.time()
+                due = False
+                while self._heap and self._heap[0][0] <= now:
+                    heapq.heappop(self._heap)
+                    due = True
+
+            polling = time.monotonic() >= next_poll
+            if polling:
+                next_poll = time.monotonic() + self.poll_interval
+                self._load_pending()
+            # Polls also pick up retries and jobs whose claimant died
+            if due or polling:
+                while not self._stopped and self._release():
+                    pass
+
+    # Renew the leases of the jobs this process is sending and tell other
+    # processes that it is alive
+    def _heartbeat(self):
+        interval = self.lease_seconds / 3
+        while not self._heartbeat_stop.is_set():
+            now = time.time()
+            try:
+                with self._db() as conn, conn:
+                    conn.execute(
+                        "UPDATE scheduled SET lease_expires = ? WHERE lease_owner = ? AND status = 'sending'",
+                        (now + self.lease_seconds, self.worker_id)
+                    )
+                    if self.sender:
+                        conn.execute(
+                            "INSERT INTO workers (id, sender, started_at, last_seen) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT(id) DO UPDATE SET last_seen = excluded.last_seen",
+                            (self.worker_id, self.sender, now, now)
+                        )
+                    # Workers that died without unregistering
+                    conn.execute("DELETE FROM workers WHERE last_seen < ?", (now - 10 * self.lease_seconds,))
+            except sqlite3.Error as e:
+                logger.warning("Scheduler heartbeat failed: %s", e)
+            self._heartbeat_stop.wait(interval)
+
+    # Claim a batch of due jobs under a lease and deliver them one after
+    # another over the pooled connection. The claim is a single UPDATE, so
+    # every job is claimed by one process only; jobs whose lease ran out are
+    # claimable again. A scheduler given a sender only has the password of
+    # that account, so it leaves other senders' jobs to the app. Returns the
+    # number of jobs claimed.
+    def _release(self):
+        claimed_at = time.time()
+        sender_filter = "AND sender = ? " if self.sender else ""
+        sender_params = (self.sender,) if self.sender else ()
+        with self._db() as conn, conn:
+            conn.execute(
+                "UPDATE scheduled SET status = 'sending', lease_owner = ?, lease_expires = ?, "
+                "claimed_at = ?, attempts = attempts + 1 "
+                "WHERE id IN (SELECT id FROM scheduled "
+                "WHERE ((status = 'pending' AND send_at <= ?) "
+                "OR (status = 'sending' AND (lease_expires IS NULL OR lease_expires < ?))) "
+                + sender_filter + "ORDER BY send_at LIMIT ?)",
+                (self.worker_id, claimed_at + self.lease_seconds, claimed_at,
+                 claimed_at, claimed_at) + sender_params + (self.batch_size,)
+            )
+            rows = conn.execute(
+                "SELECT id, send_at, sender, recipients, history_recipients, subject, message, attempts "
+                "FROM scheduled WHERE status = 'sending' AND lease_owner = ? AND claimed_at = ? ORDER BY send_at",
+                (self.worker_id, claimed_at)
+            ).fetchall()
+        if not rows:
+            return 0
+        metrics.increment("scheduler.batches")
+
+        for index, (job_id, send_at, sender, recipients, history_recipients, subject, message, attempts) in enumerate(rows):
+            if self._stopped:
+                # Hand the rest back instead of letting their leases run out
+                self._unclaim([row[0] for row in rows[index:]])
+                break
+            job = {
+                "id": job_id,
+                "send_at": send_at,
+                "sender": sender,
+                "recipients": json.loads(recipients),
+                "subject": subject,
+                "message": message_from_bytes(message),
+            }
+            if attempts > MAX_ATTEMPTS:
+                # Earlier claimants never finished it; most likely the job
+                # itself takes the worker down
+                self._finish(job, history_recipients, "failed", "FAILED",
+                             f"Gave up after {MAX_ATTEMPTS} attempts")
+                continue
+            metrics.observe("scheduler.lag", time.time() - send_at)
+            try:
+                suppressed, refused = self.deliver(job, self.credentials.get(sender)) or ((), {})
+                self._finish(job, history_recipients, "sent", "SUCCESS", None, suppressed, refused)
+            except AllRecipientsSuppressed as e:
+                self._finish(job, ", ".join(e.suppressed), "failed", "SUPPRESSED", "Address is on the suppression list")
+            except Exception as e:
+                logger.warning("Scheduled email %s failed (attempt %d): %s", job_id, attempts, e)
+                if attempts < MAX_ATTEMPTS and not is_permanent_error(e):
+                    self._retry(job_id, RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1), describe_smtp_error(e))
+                else:
+                    self._finish(job, history_recipients, "failed", "FAILED", describe_smtp_error(e))
+        return len(rows)
+
+    # Record the outcome of a job. Committed per job so a crash never causes
+    # a delivered job to be resent; the lease owner check keeps a process
+    # whose lease was taken over from overwriting the new claimant's state.
+    # Recipients suppressed or refused when it was sent get history records
+    # of their own, like messages sent from the page.
+    def _finish(self, job, history_recipients, status, history_status, error, suppressed=(), refused=None):
+        with self._db() as conn, conn:
+            updated = conn.execute(
+                "UPDATE scheduled SET status = ?, sent_at = ?, error = ?, lease_owner = NULL, lease_expires = NULL "
+                "WHERE id = ? AND lease_owner = ?",
+                (status, time.time(), error, job["id"], self.worker_id)
+            ).rowcount
+        if not updated:
+            logger.warning("Lease on scheduled email %s was lost before it was finished", job["id"])
+        metrics.increment(f"scheduler.{status}")
+        if self.record_history is None:
+            return
+        message_id = job["message"]["Message-ID"]
+        if refused:
+            self.record_history(job["sender"], ", ".join(refused), job["subject"], "FAILED",
+                                describe_smtp_error(smtplib.SMTPRecipientsRefused(refused)), message_id=message_id)
+        if suppressed or refused:
+            history_recipients = ", ".join(address for address in job["recipients"]
+                                           if address not in refused and address not in suppressed)
+        self.record_history(job["sender"], history_recipients, job["subject"], history_status, error,
+                            message_id=message_id)
+        if suppressed:
+            self.record_history(job["sender"], ", ".join(suppressed), job["subject"], "SUPPRESSED",
+                                "Address is on the suppression list", message_id=message_id)
+
+    def _retry(self, job_id, delay, error):
+        send_at = time.time() + delay
+        with self._db() as conn, conn:
+            conn.execute(
+                "UPDATE scheduled SET status = 'pending', send_at = ?, error = ?, lease_owner = NULL, "
+                "lease_expires = NULL WHERE id = ? AND lease_owner = ?",
+                (send_at, error, job_id, self.worker_id)
+            )
+        with self._cond:
+            heapq.heappush(self._heap, (send_at, job_id))
+            self._cond.notify()
+        metrics.increment("scheduler.retried")
+
+    def _unclaim(self, job_ids):
+        placeholders = ", ".join("?" * len(job_ids))
+        with self._db() as conn, conn:
+            conn.execute(
+                f"UPDATE scheduled SET status = 'pending', lease_owner = NULL, lease_expires = NULL, "
+                f"attempts = attempts - 1 WHERE lease_owner = ? AND id IN ({placeholders})",
+                [self.worker_id] + job_ids
+            )
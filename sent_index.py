@@ -0,0 +1,172 @@
+import hashlib
+import math
+import atexit
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+import metrics
+
+# Index of recently sent messages, used to stop the same message going out
+# twice when a form is resubmitted. Every message gets a deterministic
+# fingerprint; an in-memory bloom filter answers "never seen" without
+# touching disk, and SQLite holds the exact fingerprints and send times.
+INDEX_FILE = "sent_index.db"
+BLOOM_FILE = "sent_index.bloom"
+DEFAULT_WINDOW_SECONDS = int(os.getenv("SEND_DEDUP_WINDOW", "600"))
+FALSE_POSITIVE_RATE = 0.01
+
+
+# Function to fingerprint a message from its envelope and content
+def message_fingerprint(sender, recipients, subject, body, attachment=None):
+    body_hash = hashlib.sha256((body or "").encode()).hexdigest()
+    attachment_hash = hashlib.sha256(attachment).hexdigest() if attachment else ""
+    parts = [
+        (sender or "").strip().lower(),
+        ",".join(sorted(address.strip().lower() for address in recipients if address.strip())),
+        subject or "",
+        body_hash,
+        attachment_hash,
+    ]
+    return hashlib.sha256("\0".join(parts).encode()).digest()[:16]
+
+
+# Fixed-size bloom filter over 16-byte fingerprints. The fingerprints are
+# already uniformly distributed, so the bit positions are taken straight
+# from their bytes instead of hashing again.
+class BloomFilter:
+    def __init__(self, capacity):
+        self.capacity = max(capacity, 1024)
+        # Optimal sizing for the target false positive rate
+        self.size = int(-self.capacity * math.log(FALSE_POSITIVE_RATE) / (math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, fingerprint):
+        h1 = int.from_bytes(fingerprint[:8], "little")
+        h2 = int.from_bytes(fingerprint[8:16], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, fingerprint):
+        for position in self._positions(fingerprint):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, fingerprint):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(fingerprint))
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(struct.pack("<QQ", self.capacity, self.count))
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            capacity, count = struct.unpack("<QQ", f.read(16))
+            bloom = cls(capacity)
+            bits = f.read()
+        if len(bits) != len(bloom.bits):
+            raise ValueError("Bloom filter snapshot does not match its header")
+        bloom.bits = bytearray(bits)
+        bloom.count = count
+        return bloom
+
+
+class SentIndex:
+    # The bloom filter is restored from its snapshot when there is one. A
+    # snapshot that misses fingerprints added later (or by other processes)
+    # is harmless: a filter miss still goes through the exact upsert below.
+    def __init__(self, path=INDEX_FILE, bloom_path=BLOOM_FILE, window_seconds=DEFAULT_WINDOW_SECONDS):
+        self.path = path
+        self.bloom_path = bloom_path
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._dirty = False
+        conn = self._connect()
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sent ("
+                "fingerprint BLOB PRIMARY KEY, sent_at REAL NOT NULL) WITHOUT ROWID"
+            )
+            try:
+                self._bloom = BloomFilter.load(self.bloom_path)
+            except (OSError, ValueError, struct.error):
+                total = conn.execute("SELECT COUNT(*) FROM sent").fetchone()[0]
+                self._bloom = BloomFilter(total * 2)
+                self._rebuild_bloom(conn)
+        finally:
+            conn.close()
+        atexit.register(self.save)
+
+    def save(self):
+        with self._lock:
+            if self._dirty:
+                self._bloom.save(self.bloom_path)
+                self._dirty = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    # (Re)build the filter from the exact index, sized for twice the current
+    # number of fingerprints so that it does not need to grow again soon
+    def _rebuild_bloom(self, conn):
+        total = conn.execute("SELECT COUNT(*) FROM sent").fetchone()[0]
+        bloom = BloomFilter(max(total, self._bloom.count) * 2)
+        for (fingerprint,) in conn.execute("SELECT fingerprint FROM sent"):
+            bloom.add(fingerprint)
+        self._bloom = bloom
+        bloom.save(self.bloom_path)
+
+    # Function to reserve a fingerprint before sending. Returns False if the
+    # same message was sent (or is being sent) within the dedup window;
+    # force=True records the send regardless.
+    def claim(self, fingerprint, force=False):
+        now = time.time()
+        cutoff = now - self.window_seconds
+        conn = self._connect()
+        try:
+            with self._lock:
+                maybe_seen = fingerprint in self._bloom
+            if maybe_seen and not force:
+                row = conn.execute("SELECT sent_at FROM sent WHERE fingerprint = ?", (fingerprint,)).fetchone()
+                if row and row[0] >= cutoff:
+                    metrics.increment("send.duplicates_skipped")
+                    return False
+            # The conditional upsert is the arbiter between concurrent
+            # submissions, including ones from other processes
+            with conn:
+                changed = conn.execute(
+                    "INSERT INTO sent (fingerprint, sent_at) VALUES (?, ?) "
+                    "ON CONFLICT(fingerprint) DO UPDATE SET sent_at = excluded.sent_at "
+                    "WHERE sent.sent_at < ? OR ?",
+                    (fingerprint, now, cutoff, force)
+                ).rowcount
+            if not changed:
+                metrics.increment("send.duplicates_skipped")
+                return False
+            with self._lock:
+                if not maybe_seen:
+                    self._bloom.add(fingerprint)
+                    self._dirty = True
+                if self._bloom.count > self._bloom.capacity:
+                    self._rebuild_bloom(conn)
+            return True
+        finally:
+            conn.close()
+
+    # Function to give a reservation back after a failed send so it can be retried
+    def release(self, fingerprint):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM sent WHERE fingerprint = ?", (fingerprint,))
+        finally:
+            conn.close()
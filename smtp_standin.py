@@ -0,0 +1,137 @@
+import socketserver
+import ssl
+import threading
+import time
+
+# Minimal local SMTP server standing in for a real relay in benchmarks and
+# manual testing. It speaks enough ESMTP for smtplib (EHLO, STARTTLS, AUTH
+# PLAIN/LOGIN, MAIL, RCPT, DATA, RSET, NOOP, QUIT), can add a delay before
+# every reply to simulate network round trips, can reject chosen recipients
+# with a fixed reply, and can be made unavailable (421 greeting) or throttled
+# (451 to every MAIL FROM) while it runs.
+#
+#     server = StandInSMTPServer(delay=0.01, certfile="cert.pem", keyfile="key.pem")
+#     server.start()
+#     ... smtplib.SMTP("localhost", server.port) ...
+#     server.stop()
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        standin = self.server.standin
+        if standin.delay:
+            time.sleep(standin.delay)
+        self.wfile.write((line + "\r\n").encode())
+        self.wfile.flush()
+
+    def readline(self):
+        return self.rfile.readline().decode("utf-8", "replace")
+
+    def start_tls(self):
+        self.request = self.server.standin.tls_context.wrap_socket(self.request, server_side=True)
+        self.connection = self.request
+        self.rfile = self.request.makefile("rb")
+        self.wfile = self.request.makefile("wb")
+
+    def handle(self):
+        standin = self.server.standin
+        if standin.unavailable:
+            self.reply("421 Service not available")
+            return
+        self.reply("220 standin ESMTP ready")
+        secured = False
+        recipients = []
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            command = line.strip()
+            verb = command.split(" ", 1)[0].upper()
+
+            if verb == "EHLO":
+                lines = ["standin"]
+                if standin.tls_context is not None and not secured:
+                    lines.append("STARTTLS")
+                lines.append("AUTH PLAIN LOGIN")
+                lines.append("8BITMIME")
+                for line_text in lines[:-1]:
+                    self.wfile.write(f"250-{line_text}\r\n".encode())
+                self.reply(f"250 {lines[-1]}")
+            elif verb == "HELO":
+                self.reply("250 standin")
+            elif verb == "STARTTLS" and standin.tls_context is not None and not secured:
+                self.reply("220 Ready to start TLS")
+                self.start_tls()
+                secured = True
+            elif verb == "AUTH":
+                if command.upper().startswith("AUTH LOGIN"):
+                    self.reply("334 VXNlcm5hbWU6")
+                    self.readline()
+                    self.reply("334 UGFzc3dvcmQ6")
+                    self.readline()
+                self.reply("235 Authentication successful")
+            elif verb == "MAIL":
+                recipients = []
+                if standin.throttled:
+                    self.reply("451 4.7.1 Rate limited, try again later")
+                else:
+                    self.reply("250 OK")
+            elif verb == "RCPT":
+                address = command.split(":", 1)[-1].strip().strip("<>").split(">")[0]
+                if address.lower() in standin.rejected:
+                    self.reply(standin.rejected[address.lower()])
+                else:
+                    recipients.append(address)
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line in (b".\r\n", b".\n"):
+                        break
+                with standin.lock:
+                    standin.accepted += 1
+                    standin.recipients.extend(recipients)
+                self.reply("250 OK queued")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StandInSMTPServer:
+    def __init__(self, host="localhost", port=0, delay=0, certfile=None, keyfile=None, rejected=None):
+        self.delay = delay
+        self.unavailable = False
+        self.throttled = False
+        # address -> full reply line, e.g. "550 5.1.1 No such user"
+        self.rejected = {address.lower(): reply for address, reply in (rejected or {}).items()}
+        self.accepted = 0
+        self.recipients = []
+        self.lock = threading.Lock()
+        self.tls_context = None
+        if certfile:
+            self.tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.tls_context.load_cert_chain(certfile, keyfile)
+        self._server = _ThreadingServer((host, port), _SMTPHandler)
+        self._server.standin = self
+        self.host = host
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="smtp-standin", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,131 @@
+import sqlite3
+import threading
+import time
+
+import smtplib
+
+import metrics
+from mailer import PERMANENT, classify_reply_code, reply_text
+
+# Addresses that failed permanently (5xx at RCPT time) are suppressed so we
+# stop paying for connections and sends that are bound to bounce again. The
+# list lives in SQLite and is mirrored in a set, so checking a recipient is a
+# hash lookup; rows added by other processes are picked up incrementally.
+SUPPRESSION_FILE = "suppression_list.db"
+
+
+class AllRecipientsSuppressed(Exception):
+    def __init__(self, suppressed):
+        self.suppressed = suppressed
+        super().__init__("All recipients are on the suppression list: " + ", ".join(suppressed))
+
+
+class SuppressionList:
+    def __init__(self, path=SUPPRESSION_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._addresses = set()
+        self._last_rowid = 0
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS suppressed ("
+                "address TEXT PRIMARY KEY, code INTEGER, reason TEXT, added_at REAL NOT NULL)"
+            )
+            # Removals are recorded too, so other processes can drop them from their set
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS suppression_log ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, address TEXT NOT NULL, removed INTEGER NOT NULL)"
+            )
+        self._refresh()
+
+    @staticmethod
+    def _normalize(address):
+        return address.strip().lower()
+
+    # Apply changes made since the last refresh (by this or another process)
+    def _refresh(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, address, removed FROM suppression_log WHERE id > ? ORDER BY id",
+                (self._last_rowid,)
+            ).fetchall()
+            for rowid, address, removed in rows:
+                if removed:
+                    self._addresses.discard(address)
+                else:
+                    self._addresses.add(address)
+                self._last_rowid = rowid
+
+    def __contains__(self, address):
+        return self._normalize(address) in self._addresses
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def add(self, address, code=None, reason=None):
+        address = self._normalize(address)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO suppressed (address, code, reason, added_at) VALUES (?, ?, ?, ?)",
+                (address, code, reason, time.time())
+            )
+            self._conn.execute("INSERT INTO suppression_log (address, removed) VALUES (?, 0)", (address,))
+        metrics.increment("suppression.added")
+        self._refresh()
+
+    def remove(self, address):
+        address = self._normalize(address)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM suppressed WHERE address = ?", (address,))
+            self._conn.execute("INSERT INTO suppression_log (address, removed) VALUES (?, 1)", (address,))
+        self._refresh()
+
+    # Function to split recipients into (deliverable, suppressed)
+    def filter(self, recipients):
+        self._refresh()
+        deliverable, suppressed = [], []
+        for address in recipients:
+            (suppressed if self._normalize(address) in self._addresses else deliverable).append(address)
+        if suppressed:
+            metrics.increment("suppression.hits", len(suppressed))
+        return deliverable, suppressed
+
+    # Suppress every recipient in an smtplib refusal dict ({address: (code, reply)})
+    # whose reply code is permanent; returns the newly suppressed addresses
+    def record_refusals(self, refused):
+        added = []
+        for address, (code, reply) in (refused or {}).items():
+            if classify_reply_code(code) == PERMANENT:
+                self.add(address, code, reply_text(reply))
+                added.append(address)
+        return added
+
+    def entries(self, limit=500):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT address, code, reason, added_at FROM suppressed ORDER BY added_at DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [
+            {"address": address, "code": code, "reason": reason, "added_at": added_at}
+            for address, code, reason, added_at in rows
+        ]
+
+
+# Function to send through the relays (see relays.py) while honouring the
+# suppression list. Suppressed recipients are dropped before a connection is
+# opened, and recipients refused permanently by the relay are added to the
+# list. Returns (deliverable, suppressed, refused).
+def send_filtered(suppression_list, router, user, password, sender, recipients, msg):
+    deliverable, suppressed = suppression_list.filter(recipients)
+    if not deliverable:
+        raise AllRecipientsSuppressed(suppressed)
+    try:
+        refused = router.send_message(user, password, sender, deliverable, msg)
+    except smtplib.SMTPRecipientsRefused as e:
+        suppression_list.record_refusals(e.recipients)
+        raise
+    suppression_list.record_refusals(refused)
+    return deliverable, suppressed, refused
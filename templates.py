@@ -0,0 +1,429 @@
+import hashlib
+import html
+import os
+import re
+import threading
+from collections import OrderedDict
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from html.parser import HTMLParser
+
+import metrics
+
+# Body templates for plain-text and HTML emails:
+#
+#     <p>Hello {{ first_name or "there" }},</p>
+#     {% if order.total %}<p>Your order of {{ order.total }} has shipped.</p>{% endif %}
+#     {% include "footer" %}
+#
+# Placeholders are looked up in the context (dotted names go into dicts or
+# attributes) and HTML-escaped in HTML templates; missing values render
+# empty. {% if %} / {% elif %} / {% else %} / {% endif %} take a name,
+# optionally preceded by "not", and {% include "name" %} renders a partial
+# with the same context. {# ... #} is a comment.
+#
+# A template is compiled once into a Python function that builds the body
+# in a single expression; compiled templates are kept in an LRU cache keyed
+# by the hash of their source. HTML templates are also compiled into a
+# plain-text version, used as the text/plain alternative of the message,
+# so personalizing a body never parses HTML.
+CACHE_SIZE = 256
+MAX_INCLUDE_DEPTH = 10
+# Partials used by {% include %}, one file per partial named after it
+PARTIALS_DIR = os.getenv("TEMPLATE_PARTIALS_DIR", "templates")
+
+_TAG = re.compile(r"\{\{\s*(.*?)\s*\}\}|\{%\s*(.*?)\s*%\}|\{#.*?#\}", re.DOTALL)
+# No part of a name may start with "_", which keeps dunder attributes such
+# as __class__ out of reach of templates
+_PATH = r"[A-Za-z]\w*(?:\.[A-Za-z0-9]\w*)*"
+_PLACEHOLDER = re.compile(rf"({_PATH})(?:\s+or\s+(\"[^\"]*\"|'[^']*'|-?\d+(?:\.\d+)?))?$")
+_CONDITION = re.compile(rf"(not\s+)?({_PATH})$")
+_INCLUDE = re.compile(r"include\s+(\"[^\"]+\"|'[^']+')$")
+_BLANK_LINES = re.compile(r"[ \t]*\n(?:[ \t]*\n)+")
+_WHITESPACE = re.compile(r"\s+")
+# Stands in for a tag while a template is converted to plain text
+_MARKER = re.compile(r"\ue000(\d+)\ue001")
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def _escape(value):
+    if value is None:
+        return ""
+    return html.escape(value if value.__class__ is str else str(value))
+
+
+def _text(value):
+    if value is None:
+        return ""
+    return value if value.__class__ is str else str(value)
+
+
+# Resolve the rest of a dotted name in dicts or attributes
+def _lookup(value, names):
+    for name in names:
+        if value is None:
+            return None
+        try:
+            value = value[name]
+        except (KeyError, IndexError, TypeError):
+            value = getattr(value, name, None)
+    return value
+
+
+# Split a template into ("text", str), ("var", expr), ("if", expr), ("elif", expr),
+# ("else", None), ("endif", None) and ("include", name) tokens
+def _tokenize(source):
+    tokens = []
+    position = 0
+    for match in _TAG.finditer(source):
+        if match.start() > position:
+            tokens.append(("text", source[position:match.start()]))
+        position = match.end()
+        placeholder, statement = match.group(1), match.group(2)
+        if placeholder is not None:
+            tokens.append(("var", placeholder))
+        elif statement is not None:
+            keyword, _, rest = statement.partition(" ")
+            if keyword in ("if", "elif"):
+                tokens.append((keyword, rest.strip()))
+            elif keyword in ("else", "endif") and not rest.strip():
+                tokens.append((keyword, None))
+            elif keyword == "include":
+                include = _INCLUDE.match(statement)
+                if include is None:
+                    raise TemplateError(f"Invalid include: {{% {statement} %}}")
+                tokens.append(("include", include.group(1)[1:-1]))
+            else:
+                raise TemplateError(f"Unknown tag: {{% {statement} %}}")
+    if position < len(source):
+        tokens.append(("text", source[position:]))
+    return tokens
+
+
+def _value_code(path):
+    first, *rest = path.split(".")
+    if rest:
+        return f"lookup(get({first!r}), {tuple(rest)!r})"
+    return f"get({first!r})"
+
+
+# Parse tokens up to the end of the current block into a list of Python
+# expressions whose values are joined into the body
+def _parse_block(tokens, position, convert, closing=()):
+    parts = []
+    while position < len(tokens):
+        kind, value = tokens[position]
+        if kind in closing:
+            return parts, position
+        position += 1
+        if kind == "text":
+            parts.append(repr(value))
+        elif kind == "var":
+            match = _PLACEHOLDER.match(value)
+            if match is None:
+                raise TemplateError(f"Invalid placeholder: {{{{ {value} }}}}")
+            code = _value_code(match.group(1))
+            default = match.group(2)
+            if default is not None:
+                if default[0] in "\"'":
+                    default = default[1:-1]
+                code = f"({code} or {default!r})"
+            parts.append(f"{convert}({code})")
+        elif kind == "include":
+            parts.append(f"include({value!r}, ctx)")
+        elif kind == "if":
+            code, position = _parse_if(tokens, position, value, convert)
+            parts.append(code)
+        else:
+            raise TemplateError(f"Unexpected {{% {kind} %}}")
+    if closing:
+        raise TemplateError("Missing {% endif %}")
+    return parts, position
+
+
+# An if/elif/else chain becomes nested conditional expressions
+def _parse_if(tokens, position, condition, convert):
+    match = _CONDITION.match(condition)
+    if match is None:
+        raise TemplateError(f"Invalid condition: {{% if {condition} %}}")
+    test = ("not " if match.group(1) else "") + _value_code(match.group(2))
+    body, position = _parse_block(tokens, position, convert, ("elif", "else", "endif"))
+    kind, value = tokens[position]
+    position += 1
+    if kind == "elif":
+        otherwise, position = _parse_if(tokens, position, value, convert)
+    elif kind == "else":
+        parts, position = _parse_block(tokens, position, convert, ("endif",))
+        otherwise = _join_code(parts)
+        position += 1
+    else:
+        otherwise = "''"
+    return f"({_join_code(body)} if {test} else {otherwise})", position
+
+
+def _join_code(parts):
+    if not parts:
+        return "''"
+    if len(parts) == 1:
+        return parts[0]
+    return "''.join((" + ", ".join(parts) + ",))"
+
+
+# Compile tokens into render(ctx, include) -> str
+def _compile_tokens(tokens, escape):
+    parts, _ = _parse_block(tokens, 0, "convert")
+    code = f"def render(ctx, include):\n    get = ctx.get\n    return {_join_code(parts)}\n"
+    namespace = {"convert": _escape if escape else _text, "lookup": _lookup}
+    try:
+        exec(compile(code, "<template>", "exec"), namespace)
+    except (SyntaxError, RecursionError, MemoryError):
+        raise TemplateError("Template is nested too deeply")
+    return namespace["render"]
+
+
+# Converts HTML into readable plain text: paragraphs and headings are
+# separated by blank lines, list items get a dash and links keep their URL
+class _TextConverter(HTMLParser):
+    BLOCKS = {"p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "table", "ul", "ol", "blockquote",
+              "section", "article", "header", "footer", "hr", "pre", "form"}
+    LINES = {"li", "tr", "dt", "dd"}
+    SKIPPED = {"head", "style", "script", "title"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.newlines = 0
+        self.skipping = 0
+        self.preformatted = 0
+        self.links = []
+
+    def _break(self, count):
+        self.newlines = max(self.newlines, count)
+
+    def _write(self, text):
+        if self.newlines:
+            if self.parts:
+                self.parts.append("\n" * self.newlines)
+            self.newlines = 0
+            text = text.lstrip(" ")
+        elif self.parts and self.parts[-1].endswith((" ", "\n")):
+            text = text.lstrip(" ")
+        if text:
+            self.parts.append(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED:
+            self.skipping += 1
+        elif tag == "br":
+            self.parts.append("\n")
+            self.newlines = 0
+        elif tag in self.BLOCKS:
+            self._break(2)
+            if tag == "pre":
+                self.preformatted += 1
+        elif tag in self.LINES:
+            self._break(1)
+            if tag == "li":
+                self._write("- ")
+        elif tag in ("td", "th"):
+            self._write(" ")
+        elif tag == "img":
+            alt = dict(attrs).get("alt")
+            if alt:
+                self._write(alt)
+        elif tag == "a":
+            self.links.append((dict(attrs).get("href") or "", len(self.parts)))
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in self.BLOCKS:
+            self._break(2)
+            if tag == "pre":
+                self.preformatted = max(0, self.preformatted - 1)
+        elif tag in self.LINES:
+            self._break(1)
+        elif tag == "a" and self.links:
+            href, start = self.links.pop()
+            label = "".join(self.parts[start:]).strip()
+            if href and not href.startswith("#") and href not in (label, "mailto:" + label):
+                self._write(f" ({href})" if label else href)
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        if not self.preformatted:
+            data = _WHITESPACE.sub(" ", data)
+            if data == " " and (self.newlines or not self.parts or self.parts[-1].endswith((" ", "\n"))):
+                return
+        self._write(data)
+
+
+# Function to convert an HTML body into its plain-text alternative
+def html_to_text(body):
+    converter = _TextConverter()
+    converter.feed(body)
+    converter.close()
+    return _BLANK_LINES.sub("\n\n", "".join(converter.parts)).strip()
+
+
+# A link whose URL is a placeholder, "label ({{ url }})" in the text version,
+# only gets the parenthesized URL when the placeholder has a value
+def _optional_links(tokens):
+    result = []
+    for i, (kind, value) in enumerate(tokens):
+        if (kind == "var" and 0 < i < len(tokens) - 1 and _CONDITION.match(value)
+                and result[-1][0] == "text" and result[-1][1].endswith(" (")
+                and tokens[i + 1][0] == "text" and tokens[i + 1][1].startswith(")")):
+            result[-1] = ("text", result[-1][1][:-2])
+            result.extend([("if", value), ("text", " ("), (kind, value), ("text", ")"), ("endif", None)])
+            tokens[i + 1] = ("text", tokens[i + 1][1][1:])
+        else:
+            result.append((kind, value))
+    return result
+
+
+class CompiledTemplate:
+    def __init__(self, source, html_body=True):
+        self.source = source
+        self.html = html_body
+        tokens = _tokenize(source)
+        self.includes = {value for kind, value in tokens if kind == "include"}
+        self._render = _compile_tokens(tokens, escape=html_body)
+        # A partial can close or open blocks of the body around it, so a body
+        # with includes is converted to text as a whole after rendering
+        self._render_text = self._compile_text(tokens) if html_body and not self.includes else None
+
+    # The text version is compiled from the template converted to plain text,
+    # with every tag swapped for a marker the converter passes through. If a
+    # conversion loses or reorders conditionals, each body is converted after
+    # rendering instead.
+    def _compile_text(self, tokens):
+        markup = []
+        tags = []
+        for kind, value in tokens:
+            if kind == "text":
+                markup.append(value)
+            else:
+                markup.append(f"\ue000{len(tags)}\ue001")
+                tags.append((kind, value))
+        text = html_to_text("".join(markup))
+        converted = []
+        seen = []
+        position = 0
+        for match in _MARKER.finditer(text):
+            if match.start() > position:
+                converted.append(("text", text[position:match.start()]))
+            position = match.end()
+            index = int(match.group(1))
+            converted.append(tags[index])
+            if tags[index][0] in ("if", "elif", "else", "endif"):
+                seen.append(index)
+        if position < len(text):
+            converted.append(("text", text[position:]))
+        blocks = [i for i, (kind, _) in enumerate(tags) if kind in ("if", "elif", "else", "endif")]
+        if seen == blocks:
+            try:
+                render = _compile_tokens(_optional_links(converted), escape=False)
+            except TemplateError:
+                render = None
+            if render is not None:
+                return lambda ctx, include: _BLANK_LINES.sub("\n\n", render(ctx, include)).strip()
+        return lambda ctx, include: html_to_text(self._render(ctx, include))
+
+    def _include(self, partials, depth):
+        if not self.includes:
+            return None
+
+        def include(name, context):
+            if depth >= MAX_INCLUDE_DEPTH:
+                raise TemplateError(f"Partials nested more than {MAX_INCLUDE_DEPTH} deep")
+            if partials is None or name not in partials:
+                raise TemplateError(f"Unknown partial: {name}")
+            partial = compile_template(partials[name], self.html)
+            return partial._render(context, partial._include(partials, depth + 1))
+        return include
+
+    # Function to render the body for one context (a dict); partials maps
+    # the names used by {% include %} to template sources
+    def render(self, context, partials=None):
+        return self._render(context, self._include(partials, 0))
+
+    # Function to render the plain-text version of the body
+    def render_text(self, context, partials=None):
+        if self._render_text is None:
+            body = self.render(context, partials)
+            return html_to_text(body) if self.html else body
+        return self._render_text(context, None)
+
+    # Function to render the body as a MIME part ready to attach to a message
+    def render_part(self, context, partials=None):
+        body = self.render(context, partials)
+        if not self.html:
+            return message_part(body)
+        # Without a precompiled text version message_part converts the body
+        text = self._render_text(context, None) if self._render_text is not None else None
+        return message_part(body, html_body=True, text=text)
+
+
+# Function to get the compiled template for a source, compiling it on first use
+def compile_template(source, html_body=True):
+    key = (hashlib.sha256(source.encode("utf-8")).digest(), html_body)
+    with _cache_lock:
+        template = _cache.get(key)
+        if template is not None:
+            _cache.move_to_end(key)
+            return template
+    template = CompiledTemplate(source, html_body)
+    metrics.increment("templates.compiled")
+    with _cache_lock:
+        _cache[key] = template
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return template
+
+
+# Function to build the body part of a message. HTML bodies are sent as
+# multipart/alternative with a plain-text version generated from the HTML
+# unless one is given.
+def message_part(body, html_body=False, text=None):
+    if not html_body:
+        return MIMEText(body, 'plain')
+    part = MIMEMultipart('alternative')
+    part.attach(MIMEText(html_to_text(body) if text is None else text, 'plain'))
+    part.attach(MIMEText(body, 'html'))
+    return part
+
+
+# Function to parse template variables given as "name = value" lines
+def parse_variables(text):
+    variables = {}
+    for number, line in enumerate((text or "").splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        name, separator, value = line.partition("=")
+        name = name.strip()
+        if not separator or not re.fullmatch(r"[A-Za-z_]\w*", name):
+            raise TemplateError(f"Line {number} of the template variables is not \"name = value\"")
+        variables[name] = value.strip()
+    return variables
+
+
+# Function to load the partials in a directory, named after their files
+def load_partials(directory=PARTIALS_DIR):
+    partials = {}
+    if not os.path.isdir(directory):
+        return partials
+    for filename in sorted(os.listdir(directory)):
+        path = os.path.join(directory, filename)
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                partials[os.path.splitext(filename)[0]] = f.read()
+    return partials
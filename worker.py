@@ -0,0 +1,65 @@
+import logging
+import multiprocessing
+
+from history import save_to_history
+from mailer import SMTPConnectionPool
+from relays import RelayRouter, load_relays
+from scheduler import LEASE_SECONDS, SCHEDULE_FILE, Scheduler
+from suppression import SuppressionList, send_filtered
+
+# Outbox worker processes. Each worker runs a scheduler on the shared outbox
+# (see scheduler.py) with its own SMTP pool, so delivery scales with the
+# number of processes, on one machine or on several sharing the outbox file.
+#
+#     python Main.py worker --processes 4
+
+logger = logging.getLogger(__name__)
+
+
+# Function to run one worker in the foreground until it is interrupted or
+# stop_event is set. relays is a routing table as returned by load_relays().
+def run_worker(sender, password, relays=None, path=SCHEDULE_FILE,
+               batch_size=10, poll_interval=1, lease_seconds=LEASE_SECONDS, stop_event=None):
+    pool = SMTPConnectionPool()
+    router = RelayRouter(relays or load_relays(), pool).start()
+    suppression_list = SuppressionList()
+
+    def deliver(job, job_password):
+        _, suppressed, refused = send_filtered(suppression_list, router, job["sender"], job_password or password,
+                                               job["sender"], job["recipients"], job["message"])
+        return suppressed, refused
+
+    scheduler = Scheduler(deliver, save_to_history, path, batch_size=batch_size, poll_interval=poll_interval,
+                          lease_seconds=lease_seconds, sender=sender).start()
+    logger.info("Outbox worker %s started", scheduler.worker_id)
+    try:
+        if stop_event is not None:
+            stop_event.wait()
+        else:
+            scheduler.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.stop()
+        router.stop()
+        pool.close_all()
+
+
+# Function to run several workers, one process each
+def run_workers(processes, **kwargs):
+    if processes <= 1:
+        run_worker(**kwargs)
+        return
+    workers = [
+        multiprocessing.Process(target=run_worker, kwargs=kwargs, name=f"outbox-worker-{i}")
+        for i in range(processes)
+    ]
+    for process in workers:
+        process.start()
+    try:
+        for process in workers:
+            process.join()
+    except KeyboardInterrupt:
+        # Ctrl+C reaches the workers too; wait for them to hand back their jobs
+        for process in workers:
+            process.join()